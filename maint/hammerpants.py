@@ -0,0 +1,710 @@
+"""Shared helpers of the Python HAMMERPANTS maintenance scripts
+
+Python counterpart of hammerpants_dsinfo. Scripts in this directory import it
+directly (it's next to them), it's not meant to be installed.
+"""
+
+import hashlib
+import mmap
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+
+# length of a dataset ID (UUID)
+ID_LENGTH = 36
+
+
+def id2relpath(ds_id):
+    """Convert a dataset ID to its path relative to the store
+    """
+    return Path(ds_id[:3], ds_id[3:])
+
+
+def relpath2id(relpath):
+    """Convert a dataset path relative to the store to the dataset ID
+    """
+    return ''.join(Path(relpath).parts)
+
+
+def resolve_dataset(args):
+    """Determine store and dataset location like hammerpants_dsinfo
+
+    :param args: list of str
+      [<store>, <dataset ID>], [<dataset location>] or [] (dataset location
+      is the current directory)
+    :returns: tuple
+      (store path, dataset path, dataset ID)
+    :raises: ValueError
+    """
+    if len(args) == 2:
+        store = Path(args[0]).resolve()
+        ds_path = store / id2relpath(args[1])
+    elif len(args) == 1:
+        ds_path = Path(args[0]).resolve()
+        store = ds_path.parent.parent
+    elif not args and Path('ria-layout-version').exists():
+        ds_path = Path.cwd().resolve()
+        store = ds_path.parent.parent
+    else:
+        raise ValueError("Invalid arguments")
+    ds_id = relpath2id(ds_path.relative_to(store))
+    if len(ds_id) != ID_LENGTH:
+        raise ValueError("Not a HAMMERPANTS dataset location")
+    return store, ds_path, ds_id
+
+
+def import_ria_wsgi():
+    """Import the object server module from ../wsgi
+
+    It knows how to read archives and how keys are laid out in a dataset.
+    """
+    wsgi_dir = str(Path(__file__).resolve().parent.parent / 'wsgi')
+    if wsgi_dir not in sys.path:
+        sys.path.insert(0, wsgi_dir)
+    import ria_wsgi
+    return ria_wsgi
+
+
+def find_datasets(store):
+    """Find the datasets in a store
+
+    Like `find <store> -mindepth 3 -maxdepth 3 -name objects -type d`, a
+    dataset is any directory two levels down containing an `objects`
+    directory, i.e. a bare Git repository.
+
+    :param store: Path
+    :returns: list of Path
+      sorted
+    """
+    datasets = []
+    with os.scandir(str(store)) as level1:
+        for d1 in level1:
+            if not d1.is_dir():
+                continue
+            with os.scandir(d1.path) as level2:
+                for d2 in level2:
+                    if d2.is_dir() and os.path.isdir(
+                            os.path.join(d2.path, 'objects')):
+                        datasets.append(Path(d2.path))
+    return sorted(datasets)
+
+
+def tree_size(path):
+    """Total size of the files in a directory tree (not following symlinks)
+
+    :returns: int
+    """
+    size = 0
+    try:
+        with os.scandir(str(path)) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        size += tree_size(entry.path)
+                    else:
+                        size += entry.stat(follow_symlinks=False).st_size
+                except OSError:
+                    continue
+    except OSError:
+        pass
+    return size
+
+
+def repo_size(ds_path):
+    """Size of a dataset's Git object store
+    """
+    return tree_size(Path(ds_path) / 'objects')
+
+
+# git-annex key backends (w/o the 'E' suffix of the extension preserving
+# variants) hashing the content
+HASH_BACKENDS = {
+    'MD5': hashlib.md5,
+    'SHA1': hashlib.sha1,
+    'SHA224': hashlib.sha224,
+    'SHA256': hashlib.sha256,
+    'SHA384': hashlib.sha384,
+    'SHA512': hashlib.sha512,
+    'SHA3_224': hashlib.sha3_224,
+    'SHA3_256': hashlib.sha3_256,
+    'SHA3_384': hashlib.sha3_384,
+    'SHA3_512': hashlib.sha3_512,
+    'BLAKE2B160': lambda: hashlib.blake2b(digest_size=20),
+    'BLAKE2B224': lambda: hashlib.blake2b(digest_size=28),
+    'BLAKE2B256': lambda: hashlib.blake2b(digest_size=32),
+    'BLAKE2B384': lambda: hashlib.blake2b(digest_size=48),
+    'BLAKE2B512': lambda: hashlib.blake2b(digest_size=64),
+    'BLAKE2S160': lambda: hashlib.blake2s(digest_size=20),
+    'BLAKE2S224': lambda: hashlib.blake2s(digest_size=28),
+    'BLAKE2S256': lambda: hashlib.blake2s(digest_size=32),
+}
+
+
+def key_checksum(key):
+    """Get the means to verify a key's content
+
+    See https://git-annex.branchable.com/internals/key_format/
+
+    :param key: str
+    :returns: tuple or None
+      (hash constructor, expected hex digest) or None if the key doesn't
+      hash the entire content (e.g. WORM, URL or chunk keys)
+    """
+    fields, sep, name = key.partition('--')
+    if not sep:
+        return None
+    fields = fields.split('-')
+    backend = fields[0]
+    if backend.endswith('E') and backend[:-1] in HASH_BACKENDS:
+        # extension preserving variant
+        backend = backend[:-1]
+        name = name.split('.', 1)[0]
+    if backend not in HASH_BACKENDS or \
+            any(f[:1] in ('S', 'C') for f in fields[1:]):
+        return None
+    return HASH_BACKENDS[backend], name
+
+
+def key_extension(key):
+    """Get the (lowercased) extension preserved in a key, e.g. '.nii.gz'
+
+    :returns: str
+      empty if there's none
+    """
+    fields, _, name = key.partition('--')
+    if not fields.split('-')[0].endswith('E') or '.' not in name:
+        return ''
+    return name[name.index('.'):].lower()
+
+
+# archive shards of a dataset, see ria_wsgi.ARCHIVE_MANIFEST
+SHARD_PATTERN = re.compile(r'^archive-(\d{4,})\.7z$')
+
+
+def list_shards(archives_dir):
+    """
+
+    :returns: list of str
+      shard file names in order of their number
+    """
+    if not archives_dir.is_dir():
+        return []
+    return sorted((p.name for p in archives_dir.iterdir()
+                   if SHARD_PATTERN.match(p.name)),
+                  key=lambda n: int(SHARD_PATTERN.match(n).group(1)))
+
+
+def next_shard(archives_dir, reserved=()):
+    """
+
+    :param reserved: iterable
+      shard file names taken already, but not present yet
+    """
+    shards = sorted(list_shards(archives_dir) + list(reserved),
+                    key=lambda n: int(SHARD_PATTERN.match(n).group(1)))
+    number = int(SHARD_PATTERN.match(shards[-1]).group(1)) + 1 \
+        if shards else 1
+    return 'archive-{:04d}.7z'.format(number)
+
+
+def read_manifest(archives_dir):
+    """
+
+    :returns: dict
+      mapping shard file names to lists of members
+    """
+    manifest_path = archives_dir / import_ria_wsgi().ARCHIVE_MANIFEST
+    shards = dict()
+    if manifest_path.exists():
+        for member, shard in import_ria_wsgi().read_archive_manifest(
+                manifest_path).items():
+            shards.setdefault(shard, []).append(member)
+    return shards
+
+
+def write_manifest(archives_dir, shards):
+    """Replace a dataset's manifest atomically
+
+    :param shards: dict
+      mapping shard file names to lists of members
+    """
+    manifest_path = archives_dir / import_ria_wsgi().ARCHIVE_MANIFEST
+    if not any(shards.values()):
+        if manifest_path.exists():
+            manifest_path.unlink()
+        return
+    tmp = archives_dir / (import_ria_wsgi().ARCHIVE_MANIFEST + '.tmp')
+    with tmp.open('w') as f:
+        for shard in sorted(shards):
+            if shards[shard]:
+                f.write('[{}]\n'.format(shard))
+                f.writelines(m + '\n' for m in sorted(shards[shard]))
+    copy_ownership(archives_dir, tmp)
+    tmp.replace(manifest_path)
+
+
+def copy_ownership(reference, path):
+    # whoever owns the archives, owns its content
+    st = reference.stat()
+    try:
+        os.chown(str(path), st.st_uid, st.st_gid)
+    except PermissionError:
+        pass
+
+
+def list_objects(objects_dir):
+    """Get the object paths of all keys in the object tree
+
+    :returns: dict
+      mapping object paths to sizes
+    """
+    objects = dict()
+    for root, dirs, files in os.walk(str(objects_dir)):
+        for name in files:
+            path = os.path.join(root, name)
+            relpath = os.path.relpath(path, str(objects_dir))
+            # tree_1/tree_2/key_dir/key_file
+            if relpath.count(os.sep) == 3 and \
+                    os.path.basename(root) == name:
+                objects[relpath] = os.lstat(path).st_size
+    return objects
+
+
+def create_archive(archive_path, cwd, members, options):
+    """Create an archive with `members` (relative to `cwd`) and verify it
+
+    The archive is written under a temporary name and renamed into place, once
+    it's verified to contain all members.
+
+    :param options: list of str
+      7z options, e.g. ['-mx0']
+    """
+    tmp = archive_path.with_name('tmp-' + archive_path.name)
+    if tmp.exists():
+        # leftover of an interrupted run
+        tmp.unlink()
+    with tempfile.NamedTemporaryFile('w', suffix='.lst') as listfile:
+        listfile.writelines(m + '\n' for m in members)
+        listfile.flush()
+        subprocess.run(
+            ['7z', 'a'] + options + [str(tmp), '@' + listfile.name],
+            cwd=str(cwd), check=True, stdout=subprocess.DEVNULL)
+    archived = import_ria_wsgi().list_archive(tmp)
+    missing = [m for m in members
+               if m not in archived or
+               archived[m].size != (cwd / m).stat().st_size]
+    if missing:
+        tmp.unlink()
+        raise RuntimeError("{} objects missing from {}, e.g. {}".format(
+            len(missing), archive_path, missing[0]))
+    tmp.replace(archive_path)
+
+
+def remove_objects(objects_dir, members):
+    for member in members:
+        path = objects_dir / member
+        try:
+            # annex objects are read-only, as are their directories
+            path.parent.chmod(0o755)
+            path.unlink()
+        except FileNotFoundError:
+            continue
+        for parent in (path.parent, path.parent.parent,
+                       path.parent.parent.parent):
+            try:
+                parent.rmdir()
+            except OSError:
+                break
+
+
+class Journal(object):
+    """Append-only record of processed datasets
+
+    A line per dataset: path, exit status, seconds taken and completion time
+    (Unix epoch), separated by tabs. Lines are flushed as they're written, so
+    an interrupted run leaves a valid journal to resume from.
+    """
+
+    def __init__(self, path):
+        """
+
+        :param path: Path or None
+          no journal is kept if None
+        """
+        self.path = Path(path) if path else None
+        self._f = None
+
+    def read(self):
+        """Get the datasets processed successfully according to the journal
+
+        :returns: set of str
+        """
+        done = set()
+        if self.path is None or not self.path.exists():
+            return done
+        with self.path.open() as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) < 2:
+                    # e.g. truncated by a crash
+                    continue
+                if fields[1] == '0':
+                    done.add(fields[0])
+                else:
+                    done.discard(fields[0])
+        return done
+
+    def record(self, ds_path, status, seconds):
+        if self.path is None:
+            return
+        if self._f is None:
+            self._f = self.path.open('a')
+        self._f.write('{}\t{}\t{:.3f}\t{:.0f}\n'.format(ds_path, status,
+                                                         seconds, time.time()))
+        self._f.flush()
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+
+class GitError(Exception):
+    pass
+
+
+# pack object types
+_OBJ_TYPES = {1: 'commit', 2: 'tree', 3: 'blob', 4: 'tag'}
+_OFS_DELTA = 6
+_REF_DELTA = 7
+
+
+def _apply_delta(base, delta):
+    """Apply a Git pack delta to a base object's data
+    """
+
+    def varint(pos):
+        value = shift = 0
+        while True:
+            byte = delta[pos]
+            pos += 1
+            value |= (byte & 0x7f) << shift
+            shift += 7
+            if not byte & 0x80:
+                return value, pos
+
+    src_size, pos = varint(0)
+    tgt_size, pos = varint(pos)
+    if src_size != len(base):
+        raise GitError("delta base size mismatch")
+    out = bytearray()
+    while pos < len(delta):
+        op = delta[pos]
+        pos += 1
+        if op & 0x80:
+            # copy from base
+            offset = size = 0
+            for i in range(4):
+                if op & (1 << i):
+                    offset |= delta[pos] << (8 * i)
+                    pos += 1
+            for i in range(3):
+                if op & (0x10 << i):
+                    size |= delta[pos] << (8 * i)
+                    pos += 1
+            out += base[offset:offset + (size or 0x10000)]
+        elif op:
+            # insert
+            out += delta[pos:pos + op]
+            pos += op
+        else:
+            raise GitError("invalid delta opcode")
+    if len(out) != tgt_size:
+        raise GitError("delta result size mismatch")
+    return bytes(out)
+
+
+class _Pack(object):
+    """Object lookup in a pack via its version 2 index
+    """
+
+    def __init__(self, idx_path):
+        with open(str(idx_path), 'rb') as f:
+            idx = f.read()
+        if idx[:4] != b'\377tOc' or \
+                int.from_bytes(idx[4:8], 'big') != 2:
+            raise GitError("unsupported pack index: {}".format(idx_path))
+        self._idx = idx
+        self.count = int.from_bytes(idx[8 + 255 * 4:8 + 256 * 4], 'big')
+        self._shas = 8 + 256 * 4
+        self._offsets = self._shas + self.count * 24
+        self._large_offsets = self._offsets + self.count * 4
+        self.pack_path = Path(str(idx_path)[:-4] + '.pack')
+        self._pack = None
+
+    def _fanout(self, byte):
+        if byte < 0:
+            return 0
+        pos = 8 + byte * 4
+        return int.from_bytes(self._idx[pos:pos + 4], 'big')
+
+    def find(self, sha):
+        """Get the offset of an object in the pack or None
+
+        :param sha: bytes
+          binary object name
+        """
+        low, high = self._fanout(sha[0] - 1), self._fanout(sha[0])
+        idx = self._idx
+        while low < high:
+            mid = (low + high) // 2
+            pos = self._shas + mid * 20
+            current = idx[pos:pos + 20]
+            if current < sha:
+                low = mid + 1
+            elif current > sha:
+                high = mid
+            else:
+                pos = self._offsets + mid * 4
+                offset = int.from_bytes(idx[pos:pos + 4], 'big')
+                if offset & 0x80000000:
+                    pos = self._large_offsets + (offset & 0x7fffffff) * 8
+                    offset = int.from_bytes(idx[pos:pos + 8], 'big')
+                return offset
+        return None
+
+    def _inflate(self, pos, size):
+        decompressor = zlib.decompressobj()
+        out = []
+        got = 0
+        while not decompressor.eof:
+            chunk = self._pack[pos:pos + 65536]
+            if not chunk:
+                raise GitError("truncated pack: {}".format(self.pack_path))
+            pos += len(chunk)
+            data = decompressor.decompress(chunk)
+            out.append(data)
+            got += len(data)
+        data = b''.join(out)
+        if got != size:
+            raise GitError("corrupt pack: {}".format(self.pack_path))
+        return data
+
+    def read(self, offset, repo):
+        """Read the object at `offset`
+
+        :param repo: GitRepo
+          to look up the bases of REF_DELTA objects in
+        :returns: tuple
+          (type, data)
+        """
+        if self._pack is None:
+            with open(str(self.pack_path), 'rb') as f:
+                self._pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        pack = self._pack
+        pos = offset
+        byte = pack[pos]
+        pos += 1
+        obj_type = (byte >> 4) & 7
+        size = byte & 0x0f
+        shift = 4
+        while byte & 0x80:
+            byte = pack[pos]
+            pos += 1
+            size |= (byte & 0x7f) << shift
+            shift += 7
+        if obj_type == _OFS_DELTA:
+            byte = pack[pos]
+            pos += 1
+            base_offset = byte & 0x7f
+            while byte & 0x80:
+                byte = pack[pos]
+                pos += 1
+                base_offset = ((base_offset + 1) << 7) | (byte & 0x7f)
+            base_type, base = self.read(offset - base_offset, repo)
+            return base_type, _apply_delta(base, self._inflate(pos, size))
+        elif obj_type == _REF_DELTA:
+            base_type, base = repo.read_object(pack[pos:pos + 20].hex())
+            return base_type, _apply_delta(base,
+                                           self._inflate(pos + 20, size))
+        elif obj_type in _OBJ_TYPES:
+            return _OBJ_TYPES[obj_type], self._inflate(pos, size)
+        raise GitError("invalid object type in {}".format(self.pack_path))
+
+    def close(self):
+        if self._pack is not None:
+            self._pack.close()
+            self._pack = None
+
+
+class GitRepo(object):
+    """Read-only access to refs and objects of a (bare) Git repository
+
+    Reads files directly rather than calling git, which is substantially
+    cheaper for the few lookups reports need.
+    """
+
+    def __init__(self, path):
+        """
+
+        :param path: Path
+          the Git directory
+        """
+        self.path = Path(path)
+        self._packs = None
+        self._packed_refs = None
+
+    def _read_packed_refs(self):
+        if self._packed_refs is None:
+            self._packed_refs = dict()
+            try:
+                with (self.path / 'packed-refs').open() as f:
+                    for line in f:
+                        if line.startswith(('#', '^')):
+                            continue
+                        sha, _, name = line.strip().partition(' ')
+                        self._packed_refs[name] = sha
+            except FileNotFoundError:
+                pass
+        return self._packed_refs
+
+    def read_ref(self, name):
+        """Resolve a ref (following symbolic refs) to an object name
+
+        :param name: str
+          e.g. 'HEAD' or 'refs/heads/master'
+        :returns: str or None
+          None if the ref doesn't exist (e.g. HEAD of an empty repository)
+        """
+        for _ in range(10):
+            try:
+                value = (self.path / name).read_text().strip()
+            except (FileNotFoundError, NotADirectoryError):
+                return self._read_packed_refs().get(name)
+            except IsADirectoryError:
+                return None
+            if not value.startswith('ref:'):
+                return value
+            name = value[4:].strip()
+        raise GitError("symbolic ref loop at {}".format(name))
+
+    def _get_packs(self):
+        if self._packs is None:
+            pack_dir = self.path / 'objects' / 'pack'
+            try:
+                self._packs = [_Pack(p) for p in sorted(pack_dir.glob('*.idx'))]
+            except OSError:
+                self._packs = []
+        return self._packs
+
+    def read_object(self, sha):
+        """
+
+        :param sha: str
+          hex object name
+        :returns: tuple
+          (type, data)
+        """
+        try:
+            with (self.path / 'objects' / sha[:2] / sha[2:]).open('rb') as f:
+                raw = zlib.decompress(f.read())
+        except FileNotFoundError:
+            pass
+        else:
+            header, _, data = raw.partition(b'\0')
+            return header.split(b' ', 1)[0].decode(), data
+        binsha = bytes.fromhex(sha)
+        for pack in self._get_packs():
+            offset = pack.find(binsha)
+            if offset is not None:
+                return pack.read(offset, self)
+        raise GitError("object {} not found in {}".format(sha, self.path))
+
+    def read_commit(self, sha):
+        """Parse a commit's header
+
+        :returns: dict
+          with 'tree' (str), 'parents' (list of str) and 'author'/'committer'
+          (as `(name, email, timestamp, utc offset)` tuples)
+        """
+        obj_type, data = self.read_object(sha)
+        if obj_type != 'commit':
+            raise GitError("{} is a {}, not a commit".format(sha, obj_type))
+        commit = {'parents': []}
+        for line in data.split(b'\n\n', 1)[0].split(b'\n'):
+            field, _, value = line.partition(b' ')
+            if field == b'tree':
+                commit['tree'] = value.decode()
+            elif field == b'parent':
+                commit['parents'].append(value.decode())
+            elif field in (b'author', b'committer'):
+                ident, _, stamp = value.decode('utf-8', 'replace').rpartition(
+                    '> ')
+                name, _, email = ident.partition(' <')
+                timestamp, _, tz = stamp.partition(' ')
+                commit[field.decode()] = (name, email, int(timestamp), tz)
+        return commit
+
+    def read_path(self, sha, path):
+        """Get the content of a file in a commit
+
+        :param path: str
+          relative to the root of the commit's tree, e.g. '.gitmodules'
+        :returns: bytes or None
+          None if there's no such file
+        """
+        name = self.read_commit(sha)['tree']
+        for part in path.split('/'):
+            obj_type, data = self.read_object(name)
+            if obj_type != 'tree':
+                return None
+            name = None
+            pos = 0
+            # entries: <mode> <name>\0<binary object name>
+            while pos < len(data):
+                end = data.index(b'\0', pos)
+                entry_name = data[pos:end].split(b' ', 1)[1]
+                if entry_name == part.encode():
+                    name = data[end + 1:end + 21].hex()
+                    break
+                pos = end + 21
+            if name is None:
+                return None
+        obj_type, data = self.read_object(name)
+        return data if obj_type == 'blob' else None
+
+    def count_commits(self, sha):
+        """Number of commits reachable from `sha` (like `git rev-list --count`)
+        """
+        seen = {sha}
+        todo = [sha]
+        while todo:
+            for parent in self.read_commit(todo.pop())['parents']:
+                if parent not in seen:
+                    seen.add(parent)
+                    todo.append(parent)
+        return len(seen)
+
+    def close(self):
+        for pack in self._packs or []:
+            pack.close()
+
+
+def format_git_date(timestamp, tz):
+    """Format a Git timestamp and UTC offset like `git log --format=%aI`
+
+    :param timestamp: int
+    :param tz: str
+      e.g. '+0100'
+    """
+    sign = -1 if tz.startswith('-') else 1
+    offset = sign * (int(tz[1:3]) * 3600 + int(tz[3:5]) * 60)
+    return datetime.fromtimestamp(
+        timestamp, timezone(timedelta(seconds=offset))).isoformat()
@@ -12,6 +12,16 @@ Specifically this will:
   on inm7-storage
 
 
+Bulk mode: With `--recursive` (`datalad run-procedure cfg_inm7 --recursive
+[-J <jobs>]`), the dataset and all its installed subdatasets are configured.
+Instead of per dataset SSH connections and `git annex fsck` runs, the
+store-side directories, ria-layout-version files and bare repositories of all
+of them are created by a single shell script, run via one (multiplexed) SSH
+connection or locally. Then the remotes are configured and published for
+<jobs> datasets concurrently, each by a process of its own (DataLad's Python
+API isn't thread-safe).
+
+
 XXXXXXXXXXXXX  OUTDATED: XXXXXXXXXXXXXXXX
 
 It used to:
@@ -49,8 +59,11 @@ ds.create_sibling_gitlab(
 
 """
 
+import argparse
+import shlex
 import sys
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from datalad.distribution.dataset import require_dataset
 from datalad.support.sshconnector import SSHManager
 from ria_remote.remote import RIARemote
@@ -140,6 +153,61 @@ def setup_storage_tree(dataset, ssh_host, repo_path):
         subprocess.run(cmd, cwd=text_type(repo_path), check=True)
 
 
+def storage_tree_script(store_path, repo_paths):
+    """Shell script creating the store-side layout of datasets
+
+    Doesn't touch anything existing already. Prints the repository paths it
+    failed to set up.
+
+    :param store_path: Path
+      base path of the store
+    :param repo_paths: list of Path
+    :returns: str
+    """
+    lines = [
+        'store={}'.format(shlex.quote(text_type(store_path))),
+        'mkdir -p "$store" || exit 1',
+        '[ -e "$store/ria-layout-version" ] || '
+        'echo {} > "$store/ria-layout-version"'.format(
+            RIARemote.dataset_tree_version),
+        'setup() {',
+        '  mkdir -p "$1" &&',
+        '  {{ [ -e "$1/ria-layout-version" ] || '
+        'echo {} > "$1/ria-layout-version"; }} &&'.format(
+            RIARemote.object_tree_version),
+        '  { [ -e "$1/HEAD" ] || git init --bare -q "$1"; } ||',
+        '  echo "$1"',
+        '}',
+    ]
+    lines.extend('setup {}'.format(shlex.quote(text_type(p)))
+                 for p in repo_paths)
+    return '\n'.join(lines) + '\n'
+
+
+def setup_storage_trees(ssh_host, store_path, repo_paths):
+    """Create the store-side layout of many datasets at once
+
+    Replaces `setup_storage_tree()` (and the fsck it needs) for bulk
+    configuration: A single script is run via one SSH connection (or locally
+    if there's no SSH host).
+
+    :returns: set of Path
+      repositories that couldn't be set up
+    """
+    print("Initializing INM7 storage for {} datasets".format(len(repo_paths)))
+    script = storage_tree_script(store_path, repo_paths)
+    if ssh_host:
+        sshmanager = SSHManager()
+        ssh = sshmanager.get_connection(ssh_host, use_remote_annex_bundle=False)
+        ssh.open()
+        out, _ = ssh('sh -s', stdin=script.encode())
+    else:
+        out = subprocess.run(['sh', '-s'], input=script,
+                             stdout=subprocess.PIPE, universal_newlines=True,
+                             check=True).stdout
+    return set(Path(line) for line in out.splitlines() if line)
+
+
 def configure_git_remote(dataset, ssh_host, repo_path):
     """add a git remote to the bare repository"""
 
@@ -167,6 +235,77 @@ def publish_index(dataset):
     dataset.publish(to="inm7", transfer_data='none')
 
 
+def configure_in_subprocess(dataset):
+    """Configure and publish the remotes of a dataset in a separate process
+
+    Runs this procedure for just the dataset, with its store-side layout set
+    up already.
+
+    :returns: subprocess.CompletedProcess
+      with the combined output
+    """
+    return subprocess.run(
+        [sys.executable, __file__, dataset.path, '--storage-ready'],
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        universal_newlines=True)
+
+
+def configure_bulk(dataset, jobs):
+    """Configure a dataset and all its installed subdatasets"""
+    datasets = [dataset] + [
+        d for d in dataset.subdatasets(fulfilled=True, recursive=True,
+                                       result_xfm='datasets',
+                                       result_renderer=None)
+        if d.id is not None and d.repo.get_hexsha() is not None]
+    cfgs = [get_cfg(d) for d in datasets]
+
+    # one script per store (and host); typically there's just one
+    failed = set()
+    stores = dict()
+    for cfg in cfgs:
+        stores.setdefault((cfg['ssh_host'], cfg['base_path']), []).append(
+            cfg['repo_path'])
+    for (ssh_host, store_path), repo_paths in stores.items():
+        failed.update(setup_storage_trees(ssh_host, store_path, repo_paths))
+
+    todo = []
+    for ds, cfg in zip(datasets, cfgs):
+        if cfg['repo_path'] in failed:
+            lgr.error("Failed to initialize INM7 storage for %s", ds.path)
+        else:
+            todo.append(ds)
+    errors = 0
+    # threads merely wait for the processes
+    with ThreadPoolExecutor(jobs) as pool:
+        for ds, future in zip(todo, [pool.submit(configure_in_subprocess, ds)
+                                     for ds in todo]):
+            try:
+                proc = future.result()
+            except OSError as e:
+                lgr.error("Failed to configure %s: %s", ds.path, e)
+                errors += 1
+                continue
+            print(proc.stdout, end='')
+            if proc.returncode:
+                lgr.error("Failed to configure %s", ds.path)
+                errors += 1
+    if failed or errors:
+        sys.exit(1)
+
+
+parser = argparse.ArgumentParser(
+    prog='cfg_inm7',
+    description="Configure a dataset to use the INM7 data infrastructure")
+parser.add_argument('-r', '--recursive', action='store_true',
+                    help="configure all installed subdatasets, too (bulk mode)")
+parser.add_argument('-J', '--jobs', type=int, default=8,
+                    help="number of datasets configured concurrently in bulk "
+                         "mode [%(default)s]")
+# store-side layout exists already (set by bulk mode for each dataset)
+parser.add_argument('--storage-ready', action='store_true',
+                    help=argparse.SUPPRESS)
+args = parser.parse_args(sys.argv[2:])
+
 ds = require_dataset(
     sys.argv[1],
     check_installed=True,
@@ -177,12 +316,16 @@ if ds.repo.get_hexsha() is None or ds.id is None:
         "Repository at {} is not a DataLad dataset, "
         "run 'datalad create' first.".format(ds.path))
 
+if args.recursive:
+    configure_bulk(ds, args.jobs)
+    sys.exit(0)
 
 cfg = get_cfg(ds)
 configure_special_remote(ds)
 
 # Does this depend on existing remotes?
-setup_storage_tree(ds, cfg['ssh_host'], cfg['repo_path'])
+if not args.storage_ready:
+    setup_storage_tree(ds, cfg['ssh_host'], cfg['repo_path'])
 
 configure_git_remote(ds, cfg['ssh_host'], cfg['repo_path'])
 publish_index(ds)
@@ -0,0 +1,432 @@
+#!/usr/bin/env python
+"""Load/benchmark suite for ria_wsgi
+
+Three parts:
+
+  generate  create a synthetic RIA store (layout version 1 or 2, any number
+            of datasets, keys in the object tree and/or in uncompressed
+            (-mx0) or compressed archives, configurable key sizes)
+  run       drive concurrent HEAD/GET requests against the keys of such a
+            store per scenario and record req/s, latency percentiles and MB/s
+  report    compare recorded results across commits
+
+The block size content is streamed with is taken from RIA_BLOCKSIZE (see
+ria_wsgi), so streaming settings can be compared on the same commit, e.g. the
+former fixed 8 KiB blocks of servers without wsgi.file_wrapper:
+
+  RIA_BLOCKSIZE=8192 bench_wsgi.py run /tmp/store --no-file-wrapper
+  bench_wsgi.py run /tmp/store --no-file-wrapper
+
+Examples:
+
+  bench_wsgi.py generate /tmp/store --datasets 4 --keys 500 \\
+      --sizes lognormal:64k:2 --archived 0.5 --compression mx0
+  bench_wsgi.py run /tmp/store --serve wsgi --concurrency 8 --duration 10
+  bench_wsgi.py report
+
+Results are appended as JSON lines to bench_output.txt at the top of the
+repository (ignored by git), labeled with the current commit.
+"""
+
+import argparse
+import hashlib
+import http.client
+import json
+import math
+import multiprocessing
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+from ria_wsgi import BLOCKSIZE, dirhash_mixed
+
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+OUTPUT = REPO_DIR / 'bench_output.txt'
+# name of the file listing the generated keys within a store
+MANIFEST = 'bench-keys.json'
+UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+# scenario -> (key location, share of HEAD requests)
+SCENARIOS = {
+    'tree-head': ('tree', 1.0),
+    'tree-get': ('tree', 0.0),
+    'archive-head': ('archive', 1.0),
+    'archive-get': ('archive', 0.0),
+    'mixed': (None, 0.5),
+}
+
+
+def parse_size(value):
+    value = value.strip().lower().rstrip('b')
+    unit = value[-1] if value and value[-1] in UNITS else ''
+    return int(float(value[:len(value) - len(unit)]) * UNITS[unit])
+
+
+def size_sampler(spec, rng):
+    """Get a callable drawing key sizes according to `spec`
+
+    :param spec: str
+      'fixed:SIZE', 'uniform:MIN:MAX' or 'lognormal:MEDIAN:SIGMA' with sizes
+      optionally suffixed by k, M or G
+    :param rng: random.Random
+    :returns: callable
+    """
+    kind, *args = spec.split(':')
+    if kind == 'fixed' and len(args) == 1:
+        size = parse_size(args[0])
+        return lambda: size
+    if kind == 'uniform' and len(args) == 2:
+        low, high = map(parse_size, args)
+        return lambda: rng.randint(low, high)
+    if kind == 'lognormal' and len(args) == 2:
+        mu, sigma = math.log(parse_size(args[0])), float(args[1])
+        return lambda: max(1, int(rng.lognormvariate(mu, sigma)))
+    raise ValueError("invalid size distribution: {}".format(spec))
+
+
+def generate(args):
+    """Create a synthetic store
+    """
+    store = Path(args.store)
+    if store.exists() and any(store.iterdir()):
+        if not args.force:
+            sys.exit("{} exists already; use --force to replace a generated "
+                     "store".format(store))
+        if not (store / MANIFEST).exists():
+            sys.exit("{} exists, but isn't a generated store; not "
+                     "replaced".format(store))
+        shutil.rmtree(str(store))
+    rng = random.Random(args.seed)
+    draw_size = size_sampler(args.sizes, rng)
+    store.mkdir(parents=True, exist_ok=True)
+    (store / 'ria-layout-version').write_text('1')
+
+    manifest = []
+    for ds in range(args.datasets):
+        ds_id = '{:08x}-bench-{:04d}'.format(rng.getrandbits(32), ds)
+        ds_dir = store / ds_id[:3] / ds_id[3:]
+        objects_dir = ds_dir / 'annex' / 'objects'
+        objects_dir.mkdir(parents=True)
+        (ds_dir / 'ria-layout-version').write_text(args.layout)
+
+        archived = []
+        for _ in range(args.keys):
+            content = rng.randbytes(draw_size())
+            key = 'MD5E-s{}--{}.dat'.format(len(content),
+                                            hashlib.md5(content).hexdigest())
+            mixed = Path(dirhash_mixed(key), key, key)
+            if args.layout == '1':
+                md5 = hashlib.md5(key.encode()).hexdigest()
+                object_path = Path(md5[:3], md5[3:], key, key)
+            else:
+                object_path = mixed
+            (objects_dir / object_path).parent.mkdir(parents=True,
+                                                     exist_ok=True)
+            (objects_dir / object_path).write_bytes(content)
+            in_archive = rng.random() < args.archived
+            if in_archive:
+                archived.append(str(object_path))
+            manifest.append({
+                'path': '/'.join((ds_id[:3], ds_id[3:], 'annex', 'objects',
+                                  str(mixed))),
+                'size': len(content),
+                'location': 'archive' if in_archive else 'tree',
+            })
+
+        if archived:
+            (ds_dir / 'archives').mkdir()
+            listfile = ds_dir / 'archives' / 'bench-members.txt'
+            listfile.write_text('\n'.join(archived) + '\n')
+            subprocess.run(['7z', 'a', '-' + args.compression,
+                            str(ds_dir / 'archives' / 'archive.7z'),
+                            '@' + str(listfile)],
+                           cwd=str(objects_dir), check=True,
+                           stdout=subprocess.DEVNULL)
+            listfile.unlink()
+            for object_path in archived:
+                (objects_dir / object_path).unlink()
+
+    (store / MANIFEST).write_text(json.dumps({
+        'layout': args.layout,
+        'datasets': args.datasets,
+        'keys_per_dataset': args.keys,
+        'archived': args.archived,
+        'compression': args.compression,
+        'sizes': args.sizes,
+        'keys': manifest,
+    }))
+    print("{} keys in {} datasets at {}".format(len(manifest), args.datasets,
+                                                 store))
+
+
+class _ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class _QuietHandler(WSGIRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+
+def _serve(kind, store, queue, file_wrapper=True):
+    if kind == 'wsgi':
+        import ria_wsgi
+
+        def app(environ, start_response):
+            environ['CONTEXT_DOCUMENT_ROOT'] = store
+            if not file_wrapper:
+                # like servers, that don't provide one
+                del environ['wsgi.file_wrapper']
+            return ria_wsgi.application(environ, start_response)
+
+        httpd = make_server('127.0.0.1', 0, app,
+                            server_class=_ThreadingWSGIServer,
+                            handler_class=_QuietHandler)
+        queue.put(httpd.server_port)
+        httpd.serve_forever()
+    else:
+        import uvicorn
+        import ria_asgi
+
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(128)
+        queue.put(sock.getsockname()[1])
+        config = uvicorn.Config(ria_asgi.make_application(store),
+                                log_level='warning', lifespan='off')
+        uvicorn.Server(config).run(sockets=[sock])
+
+
+def _percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def drive(url, paths, head_share, concurrency, duration, seed):
+    """Send requests from `concurrency` threads for `duration` seconds
+
+    :returns: dict
+    """
+    parts = urlsplit(url)
+    base = parts.path.rstrip('/')
+    latencies = []
+    counts = {'requests': 0, 'errors': 0, 'bytes': 0}
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def worker(n):
+        rng = random.Random(seed + n)
+        conn = http.client.HTTPConnection(parts.hostname, parts.port)
+        mine = []
+        errors = 0
+        received = 0
+        while time.monotonic() < deadline:
+            method = 'HEAD' if rng.random() < head_share else 'GET'
+            start = time.monotonic()
+            try:
+                conn.request(method, '{}/{}'.format(base, rng.choice(paths)))
+                response = conn.getresponse()
+                while True:
+                    block = response.read(65536)
+                    if not block:
+                        break
+                    received += len(block)
+                if response.status != 200:
+                    errors += 1
+            except (OSError, http.client.HTTPException):
+                errors += 1
+                conn.close()
+                conn = http.client.HTTPConnection(parts.hostname, parts.port)
+            mine.append(time.monotonic() - start)
+        conn.close()
+        with lock:
+            latencies.extend(mine)
+            counts['requests'] += len(mine)
+            counts['errors'] += errors
+            counts['bytes'] += received
+
+    start = time.monotonic()
+    threads = [threading.Thread(target=worker, args=(n,))
+               for n in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.monotonic() - start
+    p50, p99 = _percentile(latencies, 0.5), _percentile(latencies, 0.99)
+    return dict(
+        counts,
+        seconds=round(elapsed, 3),
+        rps=round(counts['requests'] / elapsed, 1),
+        p50_ms=round(p50 * 1000, 2) if p50 is not None else None,
+        p99_ms=round(p99 * 1000, 2) if p99 is not None else None,
+        mb_s=round(counts['bytes'] / elapsed / 1024 ** 2, 2),
+    )
+
+
+def current_commit():
+    try:
+        return subprocess.run(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=str(REPO_DIR), stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL, universal_newlines=True,
+            check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def run(args):
+    """Run scenarios against a generated store
+    """
+    manifest = json.loads((Path(args.store) / MANIFEST).read_text())
+    server = None
+    if args.url:
+        url = args.url
+    else:
+        queue = multiprocessing.Queue()
+        server = multiprocessing.Process(
+            target=_serve, args=(args.serve, str(Path(args.store).resolve()),
+                                 queue, not args.no_file_wrapper),
+            daemon=True)
+        server.start()
+        url = 'http://127.0.0.1:{}/'.format(queue.get(timeout=30))
+
+    commit = current_commit()
+    try:
+        for scenario in args.scenario or sorted(SCENARIOS):
+            location, head_share = SCENARIOS[scenario]
+            paths = [k['path'] for k in manifest['keys']
+                     if location is None or k['location'] == location]
+            if not paths:
+                print("{}: no keys; skipped".format(scenario))
+                continue
+            result = drive(url, paths, head_share, args.concurrency,
+                           args.duration, args.seed)
+            result.update(
+                commit=commit,
+                scenario=scenario,
+                server=args.url or args.serve +
+                ('-nofw' if args.no_file_wrapper else ''),
+                blocksize=BLOCKSIZE,
+                concurrency=args.concurrency,
+                layout=manifest['layout'],
+                # store shape; not recorded by older versions
+                datasets=manifest.get('datasets'),
+                keys_per_dataset=manifest.get('keys_per_dataset'),
+                archived=manifest.get('archived'),
+                compression=manifest['compression'],
+                sizes=manifest['sizes'],
+            )
+            print("{scenario:14} {rps:>9} req/s  p50 {p50_ms} ms  "
+                  "p99 {p99_ms} ms  {mb_s} MB/s  {errors} errors"
+                  "".format(**result))
+            with open(str(args.output), 'a') as f:
+                f.write(json.dumps(result, sort_keys=True) + '\n')
+    finally:
+        if server is not None:
+            server.terminate()
+            server.join()
+
+
+def report(args):
+    """Tabulate recorded results, one row per commit and scenario
+    """
+    results = []
+    with open(str(args.output)) as f:
+        for line in f:
+            if line.strip():
+                results.append(json.loads(line))
+    if args.scenario:
+        results = [r for r in results if r['scenario'] in args.scenario]
+
+    configuration = ('commit', 'scenario', 'server', 'blocksize',
+                     'concurrency', 'layout', 'datasets', 'keys_per_dataset',
+                     'archived', 'compression', 'sizes')
+    columns = configuration + ('rps', 'p50_ms', 'p99_ms', 'mb_s', 'errors')
+    # latest result per configuration and commit, in order of first recording
+    latest = dict()
+    for r in results:
+        latest[tuple(r.get(c) for c in configuration)] = r
+    rows = [[str(r.get(c)) for c in columns] for r in latest.values()]
+    rows.sort(key=lambda row: row[1:len(configuration)])
+    widths = [max(len(c), *(len(row[i]) for row in rows))
+              if rows else len(c) for i, c in enumerate(columns)]
+    for row in [list(columns)] + rows:
+        print('  '.join(v.ljust(w) for v, w in zip(row, widths)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    p = subparsers.add_parser('generate', help=generate.__doc__.strip())
+    p.add_argument('store', help="store directory to create")
+    p.add_argument('--layout', choices=('1', '2'), default='1',
+                   help="dataset layout version [%(default)s]")
+    p.add_argument('--datasets', type=int, default=1,
+                   help="number of datasets [%(default)s]")
+    p.add_argument('--keys', type=int, default=100,
+                   help="number of keys per dataset [%(default)s]")
+    p.add_argument('--sizes', default='fixed:64k',
+                   help="key size distribution: fixed:SIZE, uniform:MIN:MAX "
+                        "or lognormal:MEDIAN:SIGMA [%(default)s]")
+    p.add_argument('--archived', type=float, default=0.5,
+                   help="fraction of keys moved into archives "
+                        "[%(default)s]")
+    p.add_argument('--compression', default='mx0',
+                   choices=['mx{}'.format(i) for i in range(10)],
+                   help="7z compression level of archives [%(default)s]")
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--force', action='store_true',
+                   help="replace a store generated before")
+    p.set_defaults(func=generate)
+
+    p = subparsers.add_parser('run', help=run.__doc__.strip())
+    p.add_argument('store', help="store created by 'generate'")
+    server = p.add_mutually_exclusive_group()
+    server.add_argument('--url',
+                        help="URL of a server serving the store, e.g. "
+                             "Apache with mod_wsgi")
+    server.add_argument('--serve', choices=('wsgi', 'asgi'), default='wsgi',
+                        help="start a local server (threaded wsgiref or "
+                             "uvicorn) [%(default)s]")
+    p.add_argument('--no-file-wrapper', action='store_true',
+                   help="don't offer wsgi.file_wrapper to ria_wsgi (local "
+                        "wsgi server only)")
+    p.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                   help="scenario to run (repeatable) [all]")
+    p.add_argument('--concurrency', type=int, default=4,
+                   help="number of concurrent clients [%(default)s]")
+    p.add_argument('--duration', type=float, default=10,
+                   help="seconds per scenario [%(default)s]")
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--output', type=Path, default=OUTPUT,
+                   help="file to append results to [%(default)s]")
+    p.set_defaults(func=run)
+
+    p = subparsers.add_parser('report', help=report.__doc__.strip())
+    p.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                   help="scenario to report (repeatable) [all]")
+    p.add_argument('--output', type=Path, default=OUTPUT,
+                   help="file with recorded results [%(default)s]")
+    p.set_defaults(func=report)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,547 @@
+#!/usr/bin/env python
+
+# WSGI application serving the git repositories of a RIA store via HTTP
+#
+# Everything is passed on to git-http-backend, except for what can be served
+# from a cache:
+# - the ref advertisement of git-upload-pack (GET info/refs) is cached in
+#   memory,
+# - responses of git-upload-pack to requests without "have" lines, i.e. the
+#   packs of plain clones (and protocol v2's ls-refs), are cached on disk if
+#   RIA_GIT_CACHE points to a (writable) directory.
+#
+# Cached responses are keyed on the request and on a signature of the
+# repository's refs (HEAD, packed-refs and the loose refs directories), config
+# and shallow file, so they're used as long as none of those changed. Identical
+# requests arriving while a response is generated wait for it, rather than
+# having git compute the same pack over and over (e.g. when a job array clones
+# a dataset hundreds of times at once).
+#
+# The store location is taken from CONTEXT_DOCUMENT_ROOT (provided by Apache)
+# and passed to git-http-backend as GIT_PROJECT_ROOT. Environment variables
+# GIT_* (e.g. GIT_HTTP_EXPORT_ALL, see git-http-backend(1)) of the request
+# are passed on as well.
+
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import sys
+import threading
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from urllib.parse import parse_qs
+
+
+# ATM this needs to be adjusted to server config and may need to be
+# "SCRIPT_NAME" for example (cf. ria_wsgi):
+PATH_IN_ENV = "PATH_INFO"
+# Max. number of bytes read (and passed on) at once when streaming
+BLOCKSIZE = 1024 ** 2
+# Directory to cache git-upload-pack responses in (not cached if not set) and
+# the max. total size of the cached responses
+CACHE_DIR = os.environ.get("RIA_GIT_CACHE")
+CACHE_SIZE = int(os.environ.get("RIA_GIT_CACHE_SIZE", 10 * 1024 ** 3))
+# Max. number of ref advertisements kept in memory (per server process)
+ADVERTISEMENT_CACHE_SIZE = 256
+# Max. size of a git-upload-pack request (body) considered for caching
+MAX_CACHED_REQUEST = 1024 ** 2
+# Files of a repository, whose changes invalidate its cached responses (in
+# addition to the directories under refs/)
+SIGNATURE_FILES = ('HEAD', 'packed-refs', 'config', 'shallow')
+UPLOAD_PACK_ADVERTISEMENT = '/info/refs'
+UPLOAD_PACK = '/git-upload-pack'
+
+logger = logging.getLogger('git_wsgi')
+
+
+class LRUCache(object):
+    """Thread-safe, size-bounded mapping evicting least recently used items
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._items.move_to_end(key)
+            except KeyError:
+                return default
+            return self._items[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+
+class KeyLocks(object):
+    """Per key locks, held while a response for that key is generated
+    """
+
+    def __init__(self):
+        # key -> [lock, number of users]
+        self._locks = dict()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def __call__(self, key):
+        with self._lock:
+            entry = self._locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[key]
+
+
+advertisements = LRUCache(ADVERTISEMENT_CACHE_SIZE)
+advertisement_locks = KeyLocks()
+
+
+class BackendResponse(object):
+    """Body of a git-http-backend response, streamed from the CGI process
+
+    Closing it ends the process.
+    """
+
+    def __init__(self, process, feeder):
+        self.process = process
+        self.feeder = feeder
+
+    def __iter__(self):
+        while True:
+            # pass on whatever is there, e.g. progress messages
+            block = self.process.stdout.read1(BLOCKSIZE)
+            if not block:
+                return
+            yield block
+
+    def close(self):
+        if self.process.poll() is None:
+            # e.g. the client is gone
+            self.process.kill()
+        self.process.stdout.close()
+        self.process.wait()
+        self.feeder.join()
+
+
+def refs_signature(repo_dir):
+    """Signature of the state of a repository's refs
+
+    Loose refs are updated by renaming a lock file, which changes the mtime
+    of their directory.
+
+    :param repo_dir: Path
+    :returns: str
+    """
+    signature = [str(repo_dir)]
+    for name in SIGNATURE_FILES:
+        try:
+            st = os.stat(str(repo_dir / name))
+        except FileNotFoundError:
+            continue
+        signature.append((name, st.st_ino, st.st_size, st.st_mtime_ns))
+    for path, dirs, _ in os.walk(str(repo_dir / 'refs')):
+        dirs.sort()
+        st = os.stat(path)
+        signature.append((path, st.st_ino, st.st_mtime_ns))
+    return hashlib.sha256(repr(signature).encode()).hexdigest()
+
+
+def get_repo_dir(environ, suffix):
+    """Repository a request addresses
+
+    :param suffix: str
+      the (known) part of the request path following the repository
+    :returns: Path or None
+      None, if the path doesn't point to a bare repository
+    """
+    path = environ.get(PATH_IN_ENV) or ''
+    if not path.endswith(suffix) or '/../' in path + '/':
+        return None
+    repo_dir = Path(environ.get("CONTEXT_DOCUMENT_ROOT", '/')).joinpath(
+        *path[:-len(suffix)].split('/'))
+    if not (repo_dir / 'HEAD').is_file() or \
+            not (repo_dir / 'objects').is_dir():
+        return None
+    return repo_dir
+
+
+def request_key(environ, signature, body=b''):
+    """Cache key of a request to a repository in the state of `signature`
+    """
+    h = hashlib.sha256()
+    for value in (environ.get(PATH_IN_ENV), environ.get('QUERY_STRING'),
+                  environ.get('HTTP_GIT_PROTOCOL'),
+                  environ.get('CONTENT_TYPE'),
+                  environ.get('HTTP_CONTENT_ENCODING'), signature):
+        h.update((value or '').encode('utf-8') + b'\0')
+    h.update(body)
+    return h.hexdigest()
+
+
+def read_request_body(environ, limit):
+    """Read a request body, if it isn't larger than `limit`
+
+    :returns: bytes or None
+      None if the body wasn't read (it's too large or of unknown length)
+    """
+    try:
+        length = int(environ.get('CONTENT_LENGTH') or '')
+    except ValueError:
+        # e.g. chunked
+        return None
+    if length > limit:
+        return None
+    body = []
+    while length > 0:
+        block = environ['wsgi.input'].read(length)
+        if not block:
+            break
+        body.append(block)
+        length -= len(block)
+    return b''.join(body)
+
+
+def iter_pkt_lines(data):
+    """Payloads of git pkt-lines; None for special packets (flush etc.)
+
+    :raises: ValueError on malformed data
+    """
+    pos = 0
+    while pos < len(data):
+        length = int(data[pos:pos + 4], 16)
+        if length < 4:
+            yield None
+            pos += 4
+            continue
+        if pos + length > len(data):
+            raise ValueError("truncated pkt-line")
+        yield data[pos + 4:pos + length]
+        pos += length
+
+
+def sends_haves(body, content_encoding=None):
+    """Whether a git-upload-pack request states objects the client has
+
+    If not, the response only depends on the request and the repository's
+    refs (e.g. a plain clone).
+
+    :param body: bytes
+    :param content_encoding: str or None
+    :returns: bool
+      True if it does or if that can't be determined
+    """
+    if content_encoding in ('gzip', 'x-gzip'):
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            body = decompressor.decompress(body, 16 * MAX_CACHED_REQUEST)
+        except zlib.error:
+            return True
+        if decompressor.unconsumed_tail:
+            return True
+    elif content_encoding:
+        return True
+    try:
+        return any(line is not None and line.startswith(b'have ')
+                   for line in iter_pkt_lines(body))
+    except ValueError:
+        return True
+
+
+def backend_environ(environ, content_length):
+    """CGI environment for git-http-backend
+    """
+    env = dict(os.environ)
+    for name, value in environ.items():
+        if isinstance(value, str) and (
+                name.startswith(('HTTP_', 'GIT_')) or name in (
+                    'REQUEST_METHOD', 'QUERY_STRING', 'CONTENT_TYPE',
+                    'REMOTE_USER', 'REMOTE_ADDR', 'AUTH_TYPE',
+                    'SERVER_PROTOCOL')):
+            env[name] = value
+    # the body is passed on as is; it's up to the server to dechunk it
+    env.pop('HTTP_TRANSFER_ENCODING', None)
+    env.pop('CONTENT_LENGTH', None)
+    if content_length is not None:
+        env['CONTENT_LENGTH'] = str(content_length)
+    env['PATH_INFO'] = environ.get(PATH_IN_ENV) or '/'
+    env['GIT_PROJECT_ROOT'] = environ.get("CONTEXT_DOCUMENT_ROOT", '/')
+    return env
+
+
+def feed(stdin, body, wsgi_input, remaining):
+    """Write a request body to the backend process
+
+    :param body: bytes
+      the part of the body, that was read already
+    :param remaining: int or None
+      number of bytes to still read from `wsgi_input`; until EOF if None
+    """
+    try:
+        stdin.write(body)
+        while remaining is None or remaining > 0:
+            block = wsgi_input.read(
+                BLOCKSIZE if remaining is None else min(remaining, BLOCKSIZE))
+            if not block:
+                break
+            stdin.write(block)
+            if remaining is not None:
+                remaining -= len(block)
+    except (OSError, ValueError):
+        # backend is done reading (or gone)
+        pass
+    finally:
+        try:
+            stdin.close()
+        except OSError:
+            pass
+
+
+def run_backend(environ, body=None):
+    """Pass a request on to git-http-backend
+
+    :param body: bytes or None
+      the request body if it was read already; read from wsgi.input otherwise
+    :returns: tuple
+      (status, headers, BackendResponse)
+    """
+    if body is not None:
+        content_length, remaining = len(body), 0
+    else:
+        try:
+            content_length = remaining = int(environ.get('CONTENT_LENGTH') or '')
+        except ValueError:
+            content_length = remaining = None
+        if environ['REQUEST_METHOD'] in ('GET', 'HEAD'):
+            remaining = 0
+        body = b''
+    process = subprocess.Popen(['git', 'http-backend'],
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               env=backend_environ(environ, content_length))
+    # write the request while reading the response, so neither pipe blocks
+    feeder = threading.Thread(
+        target=feed,
+        args=(process.stdin, body, environ.get('wsgi.input'), remaining))
+    feeder.start()
+    response = BackendResponse(process, feeder)
+
+    status = "200 OK"
+    headers = []
+    try:
+        for line in iter(process.stdout.readline, b''):
+            line = line.decode('latin-1').rstrip('\r\n')
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            if name.lower() == 'status':
+                status = value.strip()
+            else:
+                headers.append((name, value.strip()))
+    except BaseException:
+        response.close()
+        raise
+    if not any(h[0].lower() == 'content-type' for h in headers) and \
+            not status.startswith(('204', '304')):
+        # e.g. plain error responses
+        headers.append(('Content-Type', 'text/plain'))
+    return status, headers, response
+
+
+def cached_advertisement(environ, repo_dir):
+    """Ref advertisement of git-upload-pack from the cache or generated
+
+    :returns: tuple
+      (status, headers, body)
+    """
+    key = request_key(environ, refs_signature(repo_dir))
+    with advertisement_locks(key):
+        cached = advertisements.get(key)
+        if cached is not None:
+            return cached
+        status, headers, response = run_backend(environ, b'')
+        try:
+            body = b''.join(response)
+        finally:
+            response.close()
+        if status.startswith('200'):
+            headers = [h for h in headers if h[0].lower() != 'content-length']
+            headers.append(('Content-Length', str(len(body))))
+            cached = status, headers, [body]
+            advertisements.put(key, cached)
+        return status, headers, [body]
+
+
+def iter_file(f, blocksize=BLOCKSIZE):
+    """Iterate a binary file-like blockwise, closing it when done
+    """
+    try:
+        for block in iter(lambda: f.read(blocksize), b''):
+            yield block
+    finally:
+        f.close()
+
+
+def evict(cache_dir, size):
+    """Remove least recently used responses until the cache fits `size`
+    """
+    entries = []
+    with os.scandir(cache_dir) as it:
+        for entry in it:
+            # skip locks and responses being written
+            if entry.name.startswith('.'):
+                continue
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, entry.path))
+    total = sum(e[1] for e in entries)
+    for _, entry_size, path in sorted(entries):
+        if total <= size:
+            break
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        total -= entry_size
+
+
+def open_cached(path):
+    """Open a cached response
+
+    :returns: tuple or None
+      (status, headers, file-like positioned at the body, body length)
+    """
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return None
+    try:
+        status, headers = json.loads(f.readline().decode('utf-8'))
+        length = os.fstat(f.fileno()).st_size - f.tell()
+    except BaseException:
+        f.close()
+        raise
+    # used; keep it in the cache
+    os.utime(path)
+    return status, [tuple(h) for h in headers], f, length
+
+
+def cached_upload_pack(environ, repo_dir, body):
+    """Response of git-upload-pack from the disk cache or generated
+
+    The first request generates the response into the cache, identical ones
+    (in any server process) wait for it.
+
+    :returns: tuple
+      (status, headers, body)
+    """
+    key = request_key(environ, refs_signature(repo_dir), body)
+    path = os.path.join(CACHE_DIR, key)
+    cached = open_cached(path)
+    if cached is None:
+        lock_path = os.path.join(CACHE_DIR, '.' + key + '.lock')
+        lock_fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            cached = open_cached(path)
+            if cached is None:
+                status, headers, response = run_backend(environ, body)
+                if not status.startswith('200'):
+                    # not cached, e.g. an error
+                    return status, headers, response
+                tmp_path = os.path.join(CACHE_DIR, '.{}.{}.{}'.format(
+                    key, os.getpid(), threading.get_ident()))
+                try:
+                    with open(tmp_path, 'wb') as f:
+                        f.write(json.dumps([status, [
+                            h for h in headers
+                            if h[0].lower() != 'content-length']]).encode(
+                                'utf-8') + b'\n')
+                        for block in response:
+                            f.write(block)
+                    response.close()
+                    if response.process.returncode:
+                        raise RuntimeError(
+                            "git http-backend failed ({})".format(
+                                response.process.returncode))
+                    os.replace(tmp_path, path)
+                except BaseException:
+                    response.close()
+                    if os.path.exists(tmp_path):
+                        os.unlink(tmp_path)
+                    raise
+                evict(CACHE_DIR, CACHE_SIZE)
+                cached = open_cached(path)
+        finally:
+            # while still holding the lock; waiting requests find the
+            # response then
+            try:
+                os.unlink(lock_path)
+            except FileNotFoundError:
+                pass
+            os.close(lock_fd)
+    status, headers, f, length = cached
+    return status, headers + [('Content-Length', str(length))], f
+
+
+def respond(environ):
+    """Determine the response to a request
+
+    :returns: tuple
+      (status, headers, body) with `body` being an iterable of bytes or a
+      binary file-like
+    """
+    method = environ['REQUEST_METHOD']
+    service = parse_qs(environ.get('QUERY_STRING') or '').get('service')
+    if method == 'GET' and service == ['git-upload-pack']:
+        repo_dir = get_repo_dir(environ, UPLOAD_PACK_ADVERTISEMENT)
+        if repo_dir is not None:
+            return cached_advertisement(environ, repo_dir)
+    elif method == 'POST' and CACHE_DIR:
+        repo_dir = get_repo_dir(environ, UPLOAD_PACK)
+        if repo_dir is not None:
+            body = read_request_body(environ, MAX_CACHED_REQUEST)
+            if body is not None and \
+                    not sends_haves(body, environ.get('HTTP_CONTENT_ENCODING')):
+                return cached_upload_pack(environ, repo_dir, body)
+            return run_backend(environ, body)
+    return run_backend(environ)
+
+
+def application(environ, start_response):
+    try:
+        status, response_headers, response_body = respond(environ)
+    except Exception:
+        # Note: report error class only to not reveal anything internal;
+        # details go to the server's log
+        exctype, value, tb = sys.exc_info()
+        logger.error("Internal server error", exc_info=(exctype, value, tb))
+        status = "500 Internal Server Error"
+        response_headers = [('Content-Type', 'text/html; charset=utf-8')]
+        response_body = ["<h1>{}</h1><p>{}</p>".format(
+            status, repr(exctype).strip('<>')).encode('utf-8')]
+
+    if hasattr(response_body, 'read'):
+        if 'wsgi.file_wrapper' in environ:  # optional acc. to WSGI spec
+            response_body = environ['wsgi.file_wrapper'](response_body,
+                                                         BLOCKSIZE)
+        else:
+            response_body = iter_file(response_body)
+    start_response(status, response_headers)
+    return response_body
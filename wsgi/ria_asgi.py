@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+
+# ASGI variant of ria_wsgi
+#
+# Requests are handled exactly like by ria_wsgi.application (see
+# ria_wsgi.respond), but content is streamed without tying up a worker thread
+# per request:
+# - members of compressed archives are extracted via asyncio subprocess
+#   streams (unless they go into ria_wsgi's extraction cache),
+# - object tree files and archive slices are read in a thread pool, or sent
+#   by the server via sendfile if it supports the zero-copy extension
+#   ("http.response.zerocopy"),
+# - every chunk is awaited to be sent, so a slow client throttles the
+#   extraction rather than having it buffered in memory.
+#
+# The store location is taken from the RIA_DOCUMENT_ROOT environment variable
+# (equivalent to the CONTEXT_DOCUMENT_ROOT provided by Apache to
+# ria_wsgi). Run with any ASGI server, e.g.:
+#
+#   RIA_DOCUMENT_ROOT=/path/to/store uvicorn ria_asgi:application
+
+import asyncio
+import io
+import os
+import stat
+import subprocess
+import threading
+from functools import partial
+
+from ria_wsgi import (
+    ArchiveExtraction,
+    BLOCKSIZE,
+    ExtractionUnavailableError,
+    MAX_KEYLIST_SIZE,
+    PATH_IN_ENV,
+    RETRY_AFTER,
+    RequestMetrics,
+    error_response,
+    respond,
+    server_error_response,
+    start_metrics_writer,
+    stream_blocksize,
+)
+
+
+# ATM this needs to be adjusted to the location of the store:
+DOCUMENT_ROOT = os.environ.get("RIA_DOCUMENT_ROOT", '/')
+# methods of requests, whose body is read (key lists, see ria_wsgi.respond)
+BODY_METHODS = ('POST',)
+
+
+async def read_request_body(scope, receive):
+    """Read the body of a request, if its method takes one
+
+    :returns: bytes or None
+      None if the client disconnected
+    :raises: ValueError if the body exceeds `MAX_KEYLIST_SIZE`
+    """
+    if scope['method'] not in BODY_METHODS:
+        return b''
+    for name, value in scope.get('headers', []):
+        if name == b'content-length' and value.strip().isdigit() and \
+                int(value) > MAX_KEYLIST_SIZE:
+            # don't wait for it
+            raise ValueError("request body too large")
+    body = []
+    size = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > MAX_KEYLIST_SIZE:
+            raise ValueError("request body too large")
+        body.append(chunk)
+        if not message.get('more_body'):
+            return b''.join(body)
+
+
+def make_environ(scope, body, document_root):
+    """Build the WSGI-style environment `ria_wsgi.respond()` expects
+
+    :param scope: dict
+      ASGI HTTP connection scope
+    :param body: bytes
+      request body
+    :param document_root: str
+    :returns: dict
+    """
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        PATH_IN_ENV: scope['path'],
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'CONTEXT_DOCUMENT_ROOT': document_root,
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.input': io.BytesIO(body),
+    }
+    client = scope.get('client')
+    if client:
+        environ['REMOTE_ADDR'] = client[0]
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            if name == 'CONTENT_TYPE':
+                environ[name] = value
+            continue
+        name = 'HTTP_' + name
+        environ[name] = \
+            environ[name] + ',' + value if name in environ else value
+    return environ
+
+
+async def iter_file(f, blocksize=BLOCKSIZE):
+    """Read a (blocking) file-like in a thread pool"""
+    loop = asyncio.get_running_loop()
+    while True:
+        chunk = await loop.run_in_executor(None, f.read, blocksize)
+        if not chunk:
+            return
+        yield chunk
+
+
+async def iter_blocking(iterable, lock):
+    """Iterate a (blocking) iterable of bytes in a thread pool
+
+    `lock` is held while a chunk is produced, see `close_blocking()`.
+    """
+    loop = asyncio.get_running_loop()
+    iterator = iter(iterable)
+
+    def next_chunk():
+        with lock:
+            return next(iterator, None)
+
+    while True:
+        chunk = await loop.run_in_executor(None, next_chunk)
+        if chunk is None:
+            return
+        yield chunk
+
+
+def close_blocking(iterable, lock):
+    """Close an iterable (if it can be) iterated by `iter_blocking()`
+
+    A generator can't be closed while it's producing a chunk in another
+    thread. Hence, this waits for that to be done.
+    """
+    close = getattr(iterable, 'close', None)
+    if close is not None:
+        with lock:
+            close()
+
+
+def zerocopy_region(f, length):
+    """Region of a regular file to be sent as the response body
+
+    :param f: binary file-like
+      positioned at the start of the content
+    :param length: int or None
+      max. number of bytes to send; up to the end of the file (or of the slice
+      of a `ria_wsgi.ObjectStream`) if None
+    :returns: tuple or None
+      (offset, count), or None if `f` isn't a regular file (e.g. a pipe or an
+      extraction cache entry still being written)
+    """
+    try:
+        fd = f.fileno()
+        st = os.fstat(fd)
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    # nothing has been read yet, so the position of the file descriptor is the
+    # one of the file-like (cf. ria_wsgi.ObjectStream.fileno)
+    offset = os.lseek(fd, 0, os.SEEK_CUR)
+    count = max(st.st_size - offset, 0)
+    # the descriptor of a slice is the one of the entire archive
+    for limit in (length, getattr(f, 'length', None)):
+        if limit is not None:
+            count = min(count, limit)
+    return offset, count
+
+
+async def iter_extraction(extraction, process):
+    """Stream an archive member from a running extraction process"""
+    blocksize = stream_blocksize(extraction.length)
+    skip = extraction.offset
+    while skip:
+        chunk = await process.stdout.read(min(skip, BLOCKSIZE))
+        if not chunk:
+            return
+        skip -= len(chunk)
+    remaining = extraction.length
+    while remaining is None or remaining > 0:
+        chunk = await process.stdout.read(
+            blocksize if remaining is None else min(remaining, blocksize))
+        if not chunk:
+            return
+        if remaining is not None:
+            remaining -= len(chunk)
+        yield chunk
+
+
+async def end_extraction(extraction, process):
+    """Terminate (if needed) and reap an extraction process
+
+    Releases the extraction's slot.
+    """
+    try:
+        if process.returncode is None:
+            # not (yet) done; e.g. only a range was requested or the client
+            # is gone
+            try:
+                process.kill()
+            except ProcessLookupError:
+                pass
+        await process.wait()
+    finally:
+        extraction.release()
+
+
+def make_application(document_root=DOCUMENT_ROOT):
+    """Create an ASGI application serving the store at `document_root`
+    """
+
+    async def app(scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+        if scope['type'] != 'http':
+            return
+
+        too_large = False
+        try:
+            body = await read_request_body(scope, receive)
+        except ValueError:
+            body = b''
+            too_large = True
+        if body is None:
+            # client is gone already
+            return
+
+        loop = asyncio.get_running_loop()
+        # closes files, ends extraction processes
+        cleanup = None
+        environ = make_environ(scope, body, document_root)
+        request_metrics = environ['ria.metrics'] = \
+            RequestMetrics(scope['method'], scope['path'])
+        start_metrics_writer()
+        if too_large:
+            status, headers, response_body = \
+                error_response("413 Payload Too Large")
+        else:
+            try:
+                # stat()s, reading of archive indices etc. may block
+                status, headers, response_body = \
+                    await loop.run_in_executor(None, respond, environ)
+            except Exception:
+                status, headers, response_body = server_error_response()
+
+        if isinstance(response_body, ArchiveExtraction) and \
+                response_body.cached:
+            # written to the extraction cache and possibly shared with other
+            # requests; read like a file
+            try:
+                with request_metrics.phase('extraction_start'):
+                    response_body = await loop.run_in_executor(
+                        None, response_body.start)
+            except ExtractionUnavailableError:
+                status, headers, response_body = error_response(
+                    "503 Service Unavailable",
+                    [('Retry-After', str(RETRY_AFTER))])
+            except OSError:
+                status, headers, response_body = server_error_response()
+        elif isinstance(response_body, ArchiveExtraction):
+            extraction = response_body
+            try:
+                # waiting for a slot blocks
+                with request_metrics.phase('extraction_start'):
+                    await loop.run_in_executor(None, extraction.admit)
+            except ExtractionUnavailableError:
+                status, headers, response_body = error_response(
+                    "503 Service Unavailable",
+                    [('Retry-After', str(RETRY_AFTER))])
+            else:
+                try:
+                    process = await asyncio.create_subprocess_exec(
+                        *extraction.command,
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.DEVNULL,
+                        # buffer (and read) up to a block at once
+                        limit=BLOCKSIZE)
+                except OSError:
+                    # e.g. missing 7z executable
+                    extraction.release()
+                    status, headers, response_body = server_error_response()
+                else:
+                    response_body = iter_extraction(extraction, process)
+                    cleanup = partial(end_extraction, extraction, process)
+
+        request_metrics.status = status
+
+        content_length = dict(headers).get('Content-Length')
+        length = int(content_length) if content_length else None
+        zerocopy = None
+        if hasattr(response_body, '__aiter__'):
+            chunks = response_body
+        elif hasattr(response_body, 'read'):
+            if 'http.response.zerocopy' in scope.get('extensions', {}):
+                zerocopy = zerocopy_region(response_body, length)
+            chunks = iter_file(response_body, stream_blocksize(length))
+            cleanup = partial(loop.run_in_executor, None, response_body.close)
+        else:
+            # e.g. a generator streaming a bundle
+            lock = threading.Lock()
+            chunks = iter_blocking(response_body, lock)
+            cleanup = partial(loop.run_in_executor, None, close_blocking,
+                              response_body, lock)
+
+        async def stream():
+            if zerocopy is not None:
+                offset, count = zerocopy
+                await send({'type': 'http.response.zerocopy',
+                            'file': response_body,
+                            'offset': offset,
+                            'count': count,
+                            'more_body': False})
+                request_metrics.sent(count)
+                return
+            async for chunk in chunks:
+                request_metrics.sent(len(chunk))
+                await send({'type': 'http.response.body',
+                            'body': chunk,
+                            'more_body': True})
+            # record before the client sees the response complete (and may
+            # ask for the metrics)
+            request_metrics.finish()
+            await send({'type': 'http.response.body',
+                        'body': b'',
+                        'more_body': False})
+
+        async def watch_disconnect():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+
+        try:
+            await send({
+                'type': 'http.response.start',
+                'status': int(status.split(' ', 1)[0]),
+                'headers': [(name.lower().encode('latin-1'),
+                             value.encode('latin-1'))
+                            for name, value in headers],
+            })
+            # stop streaming (and extracting) as soon as the client
+            # disconnects
+            streaming = asyncio.ensure_future(stream())
+            watching = asyncio.ensure_future(watch_disconnect())
+            done, pending = await asyncio.wait(
+                [streaming, watching], return_when=asyncio.FIRST_COMPLETED)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            if streaming in done:
+                # propagate errors
+                streaming.result()
+        finally:
+            try:
+                if cleanup is not None:
+                    await cleanup()
+            finally:
+                request_metrics.finish()
+
+    return app
+
+
+application = make_application()
@@ -1,8 +1,22 @@
 #!/usr/bin/env python
 
+import io
+import os
 import sys
+import logging
+import lzma
+import math
+import re
+import zlib
 import hashlib
 import subprocess
+import tarfile
+import tempfile
+import threading
+import time
+from collections import Counter, OrderedDict, deque, namedtuple
+from contextlib import contextmanager
+from email.utils import formatdate, parsedate_to_datetime
 from pathlib import Path
 from io import BytesIO
 
@@ -24,99 +38,1665 @@ from io import BytesIO
 #               -> How to deal with permissions?
 
 
-BLOCKSIZE = 8192
+# Max. number of bytes read (and passed on) at once when streaming content.
+# Less for smaller objects, see `stream_blocksize()`.
+BLOCKSIZE = int(os.environ.get("RIA_BLOCKSIZE", 1024 ** 2))
 # ATM this needs to be adjusted to server config and may need to be
 # "SCRIPT_NAME" for example:
 PATH_IN_ENV = "PATH_INFO"
+# Max. number of archive listings kept in memory (across all datasets served
+# by this process)
+ARCHIVE_INDEX_CACHE_SIZE = 64
+# Besides archive.7z a dataset's archives directory may contain shards
+# (archive-NNNN.7z) with keys archived later on. Their members are listed in a
+# manifest file in that directory: a line "[<shard file name>]" followed by a
+# line per member (object path).
+ARCHIVE_MANIFEST = "manifest"
+# Max. number of dataset descriptors kept in memory and the number of seconds
+# after which a descriptor is read again, even if the dataset directory's mtime
+# didn't change
+DATASET_CACHE_SIZE = 1024
+DATASET_CACHE_TTL = 10
+# Reserved names within a dataset's annex/objects directory, that address
+# special endpoints rather than keys (annex keys never start with a dot):
+# - POST a list of keys to get their presence, location and size
+PRESENCE_ENDPOINT = ".ria-presence"
+# - POST a list of keys to get their content as a tar archive; its last member
+#   lists the requested keys, that aren't in it
+BUNDLE_ENDPOINT = ".ria-bundle"
+BUNDLE_TRAILER = ".ria-bundle-missing"
+# Max. size of a request body listing keys
+MAX_KEYLIST_SIZE = 64 * 1024 * 1024
+# Number of keys in a batch above which a dataset's entire object tree is
+# listed instead of looking up keys individually
+TREE_SCAN_THRESHOLD = 1000
+# The content behind a key never changes. Let clients and proxies cache it for
+# a year (max. recommended by RFC 7234) without revalidation.
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Admission control for 7z extraction processes (per server process):
+# - max. number of concurrently running extractions
+# - max. number of concurrent extractions per client
+# - max. number of requests waiting for an extraction to become available
+# - number of seconds a request waits, before it's rejected with
+#   "503 Service Unavailable"
+MAX_EXTRACTIONS = int(os.environ.get("RIA_MAX_EXTRACTIONS", 16))
+MAX_CLIENT_EXTRACTIONS = int(os.environ.get("RIA_MAX_CLIENT_EXTRACTIONS", 4))
+MAX_EXTRACTION_QUEUE = int(os.environ.get("RIA_MAX_EXTRACTION_QUEUE", 64))
+EXTRACTION_WAIT = float(os.environ.get("RIA_EXTRACTION_WAIT", 10))
+# seconds a rejected client is asked to wait before retrying
+RETRY_AFTER = 5
+# Optional cache of members extracted from compressed archives on local
+# (scratch) disk: directory (caching is disabled if not set) and max. number of
+# bytes it may use (per server process)
+EXTRACTION_CACHE_DIR = os.environ.get("RIA_EXTRACTION_CACHE")
+EXTRACTION_CACHE_SIZE = int(os.environ.get("RIA_EXTRACTION_CACHE_SIZE",
+                                           10 * 1024 ** 3))
+# seconds after which an incomplete cache entry, that wasn't written to, is
+# considered abandoned (by a process on another host, or whose PID was reused)
+STALE_FILL_AGE = 24 * 3600
+# Request metrics (per server process) are served in the Prometheus text
+# format at <store>/.ria-metrics and, if RIA_METRICS_DIR is set, written to a
+# file per process in that directory every RIA_METRICS_INTERVAL seconds (e.g.
+# for node_exporter's textfile collector)
+METRICS_ENDPOINT = ".ria-metrics"
+METRICS_DIR = os.environ.get("RIA_METRICS_DIR")
+METRICS_INTERVAL = float(os.environ.get("RIA_METRICS_INTERVAL", 60))
+# upper bounds of the latency histograms' buckets (seconds)
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+# Requests taking longer than that many seconds are logged (disabled if 0)
+SLOW_REQUEST = float(os.environ.get("RIA_SLOW_REQUEST", 0))
+# Optional in-memory index of the keys present in a store (object trees and
+# archives of all datasets), allowing to answer requests for absent keys
+# without touching the dataset: the store's location as it's addressed by
+# requests, i.e. under the document root (disabled if not set) and
+# the number of seconds between scans for changes. Keys added to the store are
+# not served before the next scan noticed them.
+PRESENCE_INDEX_STORE = os.environ.get("RIA_PRESENCE_INDEX")
+PRESENCE_INDEX_INTERVAL = float(os.environ.get("RIA_PRESENCE_INDEX_INTERVAL",
+                                               60))
+# false positive rate of the index' filters
+PRESENCE_INDEX_ERROR_RATE = 0.01
+
+
+logger = logging.getLogger('ria_wsgi')
 
 
 class KeyNotFoundError(Exception):
     pass
 
 
+class RangeNotSatisfiableError(Exception):
+    pass
+
+
+class ArchiveFormatError(Exception):
+    pass
+
+
+class ExtractionUnavailableError(Exception):
+    pass
+
+
+class LRUCache(object):
+    """Thread-safe, size-bounded mapping evicting least recently used items
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._items.move_to_end(key)
+            except KeyError:
+                return default
+            return self._items[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._items.pop(key, default)
+
+
+class KeyLocks(object):
+    """Per key locks, so that only work on the same key is serialized
+    """
+
+    def __init__(self):
+        # key -> [lock, number of users]
+        self._locks = dict()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def __call__(self, key):
+        with self._lock:
+            entry = self._locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[key]
+
+
+class ObjectStream(object):
+    """Read-only view on a slice of a binary stream
+
+    Seekable streams (files) are positioned at `offset` right away. For
+    non-seekable streams (pipes) the first `offset` bytes are read and
+    discarded block by block.
+    """
+
+    def __init__(self, f, offset=0, length=None):
+        """
+
+        :param f: binary file-like
+        :param offset: int
+          Number of bytes to skip from the current position of `f`
+        :param length: int or None
+          Max. number of bytes to read; no limit if None
+        """
+        self._f = f
+        self._remaining = length
+        self.length = length
+        if offset:
+            if f.seekable():
+                f.seek(offset, io.SEEK_CUR)
+            else:
+                self._skip(offset)
+
+    def _skip(self, n):
+        buf = memoryview(bytearray(min(n, BLOCKSIZE)))
+        while n:
+            got = self._f.readinto(buf[:min(n, len(buf))])
+            if not got:
+                # premature end of stream; nothing left to read
+                self._remaining = 0
+                return
+            n -= got
+
+    def read(self, size=-1):
+        if self._remaining is not None:
+            if size is None or size < 0 or size > self._remaining:
+                size = self._remaining
+            if not size:
+                return b''
+        data = self._f.read(size)
+        if self._remaining is not None:
+            self._remaining -= len(data)
+        return data
+
+    def fileno(self):
+        # allows a server's file_wrapper to send from the current position of
+        # the underlying file (bounded by Content-Length)
+        return self._f.fileno()
+
+    def close(self):
+        self._f.close()
+
+
+class _Waiter(object):
+    __slots__ = ['client']
+
+    def __init__(self, client):
+        self.client = client
+
+
+class ExtractionSlots(object):
+    """Admission control for extraction processes
+
+    Limits the number of concurrent extractions overall and per client.
+    Requests waiting for a slot are served in order of arrival, skipping those
+    whose client already uses all of its slots. Those don't count against the
+    queue of other clients, but no client may have more than `queue_size`
+    requests waiting.
+    """
+
+    def __init__(self, limit, client_limit, queue_size):
+        """
+
+        :param limit: int
+          max. number of slots in use
+        :param client_limit: int
+          max. number of slots in use by the same client
+        :param queue_size: int
+          max. number of requests waiting for a slot (of clients not using
+          all of their slots), and of the same client
+        """
+        self.limit = limit
+        self.client_limit = client_limit
+        self.queue_size = queue_size
+        self.active = 0
+        self._clients = Counter()
+        self._waiting = deque()
+        self._cond = threading.Condition()
+
+    def _is_eligible(self, client):
+        return self._clients[client] < self.client_limit
+
+    def _is_next(self, waiter):
+        if self.active >= self.limit:
+            return False
+        for w in self._waiting:
+            if self._is_eligible(w.client):
+                return w is waiter
+        return False
+
+    def _is_queue_full(self, client):
+        eligible = own = 0
+        for w in self._waiting:
+            eligible += self._is_eligible(w.client)
+            own += w.client == client
+        return eligible >= self.queue_size or own >= self.queue_size
+
+    def acquire(self, client, timeout):
+        """Wait for a free slot
+
+        :param client: hashable
+          identifies the client, e.g. its address
+        :param timeout: float
+          max. seconds to wait
+        :returns: bool
+          whether a slot was acquired
+        """
+        with self._cond:
+            if self.active < self.limit and self._is_eligible(client) and \
+                    not any(self._is_eligible(w.client)
+                            for w in self._waiting):
+                # nobody to wait for
+                self.active += 1
+                self._clients[client] += 1
+                return True
+            if self._is_queue_full(client):
+                return False
+            waiter = _Waiter(client)
+            self._waiting.append(waiter)
+            deadline = time.monotonic() + timeout
+            try:
+                while not self._is_next(waiter):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+                self.active += 1
+                self._clients[client] += 1
+                return True
+            finally:
+                self._waiting.remove(waiter)
+                # the next waiter may be eligible now
+                self._cond.notify_all()
+
+    def release(self, client):
+        with self._cond:
+            self.active -= 1
+            self._clients[client] -= 1
+            if not self._clients[client]:
+                del self._clients[client]
+            self._cond.notify_all()
+
+
+extraction_slots = ExtractionSlots(MAX_EXTRACTIONS,
+                                   MAX_CLIENT_EXTRACTIONS,
+                                   MAX_EXTRACTION_QUEUE)
+
+
+class ExtractionStream(object):
+    """Output of an extraction process
+
+    Closing it terminates the process (if it's still running), reaps it and
+    releases its extraction slot.
+    """
+
+    def __init__(self, process, release):
+        """
+
+        :param process: subprocess.Popen
+        :param release: callable
+          called once the process is reaped
+        """
+        self._process = process
+        self._release = release
+
+    def read(self, size=-1):
+        return self._process.stdout.read(size)
+
+    def readinto(self, b):
+        return self._process.stdout.readinto(b)
+
+    def seekable(self):
+        return False
+
+    def fileno(self):
+        return self._process.stdout.fileno()
+
+    def wait(self):
+        """Wait for the process to exit, once all output was read
+
+        :returns: int
+          the process' return code
+        """
+        return self._process.wait()
+
+    def close(self):
+        if self._process is None:
+            # closed already
+            return
+        process, self._process = self._process, None
+        try:
+            if process.poll() is None:
+                # not done; e.g. only a range was requested or the client is
+                # gone
+                process.kill()
+            process.stdout.close()
+            process.wait()
+        finally:
+            self._release()
+
+
+class ArchiveExtraction(object):
+    """Extraction of an archive member by `7z x -so`
+
+    Instances describe the extraction; nothing is executed before `start()`.
+    """
+
+    def __init__(self, archive_path, member_path, offset=0, length=None,
+                 client=None, size=None):
+        """
+
+        :param archive_path: Path
+        :param member_path: str
+        :param offset: int
+          Number of bytes to skip from the start of the member
+        :param length: int or None
+          Max. number of bytes to read; no limit if None
+        :param client: hashable
+          identifies the requesting client for admission control
+        :param size: int or None
+          the member's size, if known
+        """
+        self.archive_path = archive_path
+        self.member_path = member_path
+        self.offset = offset
+        self.length = length
+        self.client = client
+        self.size = size
+
+    @property
+    def command(self):
+        return ['7z', 'x', '-so', str(self.archive_path), self.member_path]
+
+    @property
+    def cached(self):
+        """Whether the extraction goes into the extraction cache
+
+        Only entire members are cached.
+        """
+        return extraction_cache is not None and not self.offset and \
+            self.length is None and \
+            (self.size is None or self.size <= extraction_cache.max_bytes)
+
+    def admit(self):
+        """Wait for an extraction slot
+
+        Every admitted extraction must be `release()`d eventually. Streams
+        returned by `start()` do so when closed.
+
+        :raises: ExtractionUnavailableError
+        """
+        if not extraction_slots.acquire(self.client, EXTRACTION_WAIT):
+            raise ExtractionUnavailableError
+
+    def release(self):
+        extraction_slots.release(self.client)
+
+    def start(self):
+        """Run the extraction
+
+        :returns: binary file-like
+          7z's output, limited to the requested part of the member. Closing it
+          ends the extraction.
+        :raises: ExtractionUnavailableError, OSError
+        """
+        cached = self.cached
+        if cached:
+            # another request may have gotten there first
+            f = extraction_cache.open(self.archive_path, self.member_path)
+            if f is not None:
+                return f
+        self.admit()
+        try:
+            process = subprocess.Popen(self.command,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.DEVNULL)
+        except BaseException:
+            self.release()
+            raise
+        f = ExtractionStream(process, self.release)
+        if cached:
+            f = extraction_cache.fill(self.archive_path, self.member_path, f,
+                                      self.size)
+        elif self.offset or self.length is not None:
+            f = ObjectStream(f, self.offset, self.length)
+        return f
+
+
+class BundleExtraction(ArchiveExtraction):
+    """Extraction of several members of an archive by a single `7z x -so`
+
+    7z writes the members' content one after the other, in archive order.
+    Extractions of bundles aren't cached.
+    """
+
+    def __init__(self, archive_path, list_path, client=None):
+        """
+
+        :param archive_path: Path
+        :param list_path: str
+          file listing the member paths, one per line
+        :param client: hashable
+          identifies the requesting client for admission control
+        """
+        super().__init__(archive_path, None, client=client)
+        self.list_path = list_path
+
+    @property
+    def command(self):
+        return ['7z', 'x', '-so', '-scsUTF-8', str(self.archive_path),
+                '@' + self.list_path]
+
+    @property
+    def cached(self):
+        return False
+
+
+class CacheFill(object):
+    """Extraction being written to the extraction cache while it's read
+
+    Reading it reads from the extraction and appends to a temporary file in the
+    cache, that is renamed into place once the extraction is complete. If it's
+    closed before that, the extraction is either completed in the background
+    (if other requests follow it) or discarded.
+    """
+
+    def __init__(self, cache, name, stream, size):
+        """
+
+        :param cache: ExtractionCache
+        :param name: str
+          cache entry name
+        :param stream: ExtractionStream
+        :param size: int or None
+          expected size, if known
+        """
+        self.cache = cache
+        self.name = name
+        self.size = size
+        self.temp_path = cache.directory / '.fill-{}-{}'.format(os.getpid(),
+                                                                 name)
+        self.written = 0
+        # None while in progress, then whether the entry was cached
+        self.done = None
+        self.followers = 0
+        self.cond = threading.Condition()
+        self._out = self.temp_path.open('wb')
+        self._stream = stream
+
+    def read(self, size=-1):
+        if self._stream is None:
+            return b''
+        try:
+            data = self._stream.read(size)
+        except BaseException:
+            self._end_caching(False)
+            raise
+        if self._out is not None and data:
+            try:
+                self._out.write(data)
+                # make it available to followers
+                self._out.flush()
+            except OSError:
+                # e.g. cache disk is full; still serve the content
+                self._end_caching(False)
+            else:
+                with self.cond:
+                    self.written += len(data)
+                    self.cond.notify_all()
+        if self._out is not None and \
+                (size is None or size < 0 or (size and not data)):
+            # end of extraction
+            self._end_caching(self._stream.wait() == 0 and
+                              self.size in (None, self.written))
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def seekable(self):
+        return False
+
+    def _end_caching(self, success):
+        if self._out is None:
+            return
+        out, self._out = self._out, None
+        try:
+            out.close()
+        except OSError:
+            success = False
+        self.cache.finish(self, success)
+
+    def _complete(self):
+        try:
+            while self.read(BLOCKSIZE):
+                pass
+        finally:
+            self._end_caching(False)
+            stream, self._stream = self._stream, None
+            stream.close()
+
+    def close(self):
+        if self._stream is None:
+            return
+        if self._out is not None and self.cache.detach(self):
+            # followers depend on it
+            threading.Thread(target=self._complete, daemon=True).start()
+            return
+        self._end_caching(False)
+        stream, self._stream = self._stream, None
+        stream.close()
+
+
+class CacheFollower(object):
+    """Reader of an extraction cache entry, that's still being filled
+    """
+
+    def __init__(self, fill):
+        """
+
+        :param fill: CacheFill
+        """
+        self._fill = fill
+        # opened while the temporary file is known to exist; renaming it into
+        # place doesn't affect the opened file
+        self._f = fill.temp_path.open('rb')
+        self._pos = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return b''.join(iter(lambda: self.read(BLOCKSIZE), b''))
+        fill = self._fill
+        while True:
+            data = self._f.read(size)
+            if data or not size:
+                self._pos += len(data)
+                return data
+            with fill.cond:
+                while fill.done is None and fill.written <= self._pos:
+                    fill.cond.wait()
+                if fill.written > self._pos:
+                    continue
+                if not fill.done:
+                    raise OSError("extraction of {} failed".format(fill.name))
+                return b''
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def seekable(self):
+        return False
+
+    def close(self):
+        if self._f.closed:
+            return
+        self._f.close()
+        self._fill.cache.unfollow(self._fill)
+
+
+def is_stale_fill(name, mtime, now):
+    """Whether a temporary file of a `CacheFill` is abandoned
+
+    :param name: str
+      .fill-<PID>-<entry name>
+    :param mtime: float
+    :param now: float
+    :returns: bool
+    """
+    if now - mtime > STALE_FILL_AGE:
+        return True
+    pid = name.split('-')[1]
+    if not pid.isdigit():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except OSError:
+        # exists, but isn't ours
+        pass
+    return False
+
+
+class ExtractionCache(object):
+    """Size-bounded on-disk cache of extracted archive members
+
+    Entries are evicted least recently used first, once the cache exceeds its
+    size. Bookkeeping is per server process, picking up entries found in the
+    cache directory. Hence, if several processes share a directory, it may
+    temporarily exceed its size.
+    """
+
+    def __init__(self, directory, max_bytes):
+        """
+
+        :param directory: Path
+        :param max_bytes: int
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.total = 0
+        # entry name -> size; least recently used first
+        self._entries = None
+        # entry name -> CacheFill
+        self._fills = dict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def entry_name(archive_path, member_path):
+        return hashlib.sha256('{}\0{}'.format(archive_path,
+                                              member_path).encode()
+                              ).hexdigest()
+
+    def _load(self):
+        # under lock
+        if self._entries is not None:
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        entries = []
+        now = time.time()
+        with os.scandir(str(self.directory)) as it:
+            for entry in it:
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                if entry.name.startswith('.'):
+                    # incomplete; left behind by a process that is gone?
+                    if entry.name.startswith('.fill-') and \
+                            is_stale_fill(entry.name, st.st_mtime, now):
+                        try:
+                            os.unlink(entry.path)
+                        except OSError:
+                            pass
+                    continue
+                entries.append((st.st_mtime, entry.name, st.st_size))
+        self._entries = OrderedDict()
+        for _, name, size in sorted(entries):
+            self._entries[name] = size
+            self.total += size
+        self._evict()
+
+    def _evict(self):
+        # under lock
+        while self.total > self.max_bytes and self._entries:
+            name, size = self._entries.popitem(last=False)
+            self.total -= size
+            try:
+                (self.directory / name).unlink()
+            except FileNotFoundError:
+                pass
+
+    def _add(self, name, size):
+        # under lock
+        self.total += size - self._entries.pop(name, 0)
+        self._entries[name] = size
+        self._evict()
+
+    def open(self, archive_path, member_path, offset=0, length=None):
+        """Open a cached member for reading
+
+        Parameters as for `ArchiveExtraction`.
+
+        :returns: binary file-like or None
+          None if the member isn't cached (or being cached)
+        """
+        name = self.entry_name(archive_path, member_path)
+        with self._lock:
+            try:
+                self._load()
+                fill = self._fills.get(name)
+                if fill is not None:
+                    f = CacheFollower(fill)
+                    fill.followers += 1
+                else:
+                    f = (self.directory / name).open('rb')
+                    # the entry may have been added by another process
+                    self._add(name, os.fstat(f.fileno()).st_size)
+            except FileNotFoundError:
+                if self._entries is not None:
+                    # evicted by another process
+                    self.total -= self._entries.pop(name, 0)
+                return None
+            except OSError:
+                # unusable cache; extract instead
+                return None
+        if offset or length is not None:
+            f = ObjectStream(f, offset, length)
+        return f
+
+    def fill(self, archive_path, member_path, stream, size=None):
+        """Cache an extraction while it's read
+
+        :param stream: ExtractionStream
+          of the entire member
+        :param size: int or None
+          the member's size, if known
+        :returns: binary file-like
+          the member's content
+        """
+        name = self.entry_name(archive_path, member_path)
+        with self._lock:
+            current = self._fills.get(name)
+            if current is None:
+                try:
+                    self._load()
+                    fill = CacheFill(self, name, stream, size)
+                except OSError:
+                    # unusable cache; serve it anyway
+                    return stream
+                self._fills[name] = fill
+                return fill
+            # a concurrent request started to cache it already
+            f = CacheFollower(current)
+            current.followers += 1
+        stream.close()
+        return f
+
+    def detach(self, fill):
+        """The reader of an incomplete `fill` is gone
+
+        :returns: bool
+          whether the fill needs to be completed for its followers
+        """
+        with self._lock:
+            if fill.followers:
+                return True
+            del self._fills[fill.name]
+            return False
+
+    def unfollow(self, fill):
+        with self._lock:
+            fill.followers -= 1
+
+    def finish(self, fill, success):
+        with self._lock:
+            if self._fills.get(fill.name) is fill:
+                del self._fills[fill.name]
+            try:
+                if success:
+                    fill.temp_path.replace(self.directory / fill.name)
+                    self._add(fill.name, fill.written)
+            except OSError:
+                success = False
+            if not success:
+                try:
+                    fill.temp_path.unlink()
+                except OSError:
+                    pass
+        with fill.cond:
+            fill.done = success
+            fill.cond.notify_all()
+
+
+extraction_cache = ExtractionCache(Path(EXTRACTION_CACHE_DIR),
+                                   EXTRACTION_CACHE_SIZE) \
+    if EXTRACTION_CACHE_DIR else None
+
+
+def parse_range(value, size):
+    """Parse the value of a Range header field
+
+    Only a single range of bytes is supported. Anything else (including
+    syntactically invalid values) is to be ignored as per RFC 7233, which means
+    to serve the full content.
+
+    :param value: str
+    :param size: int
+      total size of the content
+    :returns: tuple or None
+      (first, last) position (inclusive) of the requested range or None, if the
+      header field is to be ignored
+    :raises: RangeNotSatisfiableError
+    """
+    unit, _, ranges = value.strip().partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in ranges:
+        return None
+    first, sep, last = ranges.partition('-')
+    first = first.strip()
+    last = last.strip()
+    if not sep or not (first + last).isdigit():
+        return None
+
+    if not first:
+        # suffix range: the final N bytes
+        suffix = int(last)
+        if not suffix or not size:
+            raise RangeNotSatisfiableError
+        return max(size - suffix, 0), size - 1
+
+    first = int(first)
+    if last and int(last) < first:
+        return None
+    if first >= size:
+        raise RangeNotSatisfiableError
+    return first, min(int(last), size - 1) if last else size - 1
+
+
+# A file within an archive. `offset` is the position of the member's data
+# within the archive file or None, if that isn't known.
+ArchiveMember = namedtuple('ArchiveMember', ['size', 'offset'])
+
+
+def file_signature(stat_result):
+    """Identity of a file's state; changes whenever the file is replaced or
+    modified
+    """
+    return (stat_result.st_dev, stat_result.st_ino,
+            stat_result.st_size, stat_result.st_mtime_ns)
+
+
+# 7z property IDs
+# see 7zFormat.txt of the 7-Zip sources
+_7Z_SIGNATURE = b'7z\xbc\xaf\x27\x1c'
+_7Z_END = 0x00
+_7Z_HEADER = 0x01
+_7Z_ARCHIVE_PROPERTIES = 0x02
+_7Z_ADDITIONAL_STREAMS_INFO = 0x03
+_7Z_MAIN_STREAMS_INFO = 0x04
+_7Z_FILES_INFO = 0x05
+_7Z_PACK_INFO = 0x06
+_7Z_UNPACK_INFO = 0x07
+_7Z_SUBSTREAMS_INFO = 0x08
+_7Z_SIZE = 0x09
+_7Z_CRC = 0x0A
+_7Z_FOLDER = 0x0B
+_7Z_CODERS_UNPACK_SIZE = 0x0C
+_7Z_NUM_UNPACK_STREAM = 0x0D
+_7Z_EMPTY_STREAM = 0x0E
+_7Z_EMPTY_FILE = 0x0F
+_7Z_NAME = 0x11
+_7Z_ENCODED_HEADER = 0x17
+# coder IDs
+_7Z_COPY = b'\x00'
+_7Z_LZMA = b'\x03\x01\x01'
+_7Z_LZMA2 = b'\x21'
+
+
+class _7zHeaderReader(object):
+    """Sequential reader of 7z header data"""
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def byte(self):
+        try:
+            b = self.data[self.pos]
+        except IndexError:
+            raise ArchiveFormatError("truncated header")
+        self.pos += 1
+        return b
+
+    def bytes(self, n):
+        if self.pos + n > len(self.data):
+            raise ArchiveFormatError("truncated header")
+        self.pos += n
+        return self.data[self.pos - n:self.pos]
+
+    def number(self):
+        # 7z's variable length encoding: the number of leading 1-bits of the
+        # first byte gives the number of bytes following it
+        first = self.byte()
+        mask = 0x80
+        value = 0
+        for i in range(8):
+            if not first & mask:
+                return value | ((first & (mask - 1)) << (8 * i))
+            value |= self.byte() << (8 * i)
+            mask >>= 1
+        return value
+
+    def bits(self, n):
+        bits = []
+        while len(bits) < n:
+            b = self.byte()
+            bits.extend(bool(b & (0x80 >> i)) for i in range(8))
+        return bits[:n]
+
+    def defined_bits(self, n):
+        # an "all defined" byte, optionally followed by a bit vector
+        return [True] * n if self.byte() else self.bits(n)
+
+    def skip_digests(self, n):
+        self.bytes(4 * sum(self.defined_bits(n)))
+
+    def expect(self, property_id):
+        if self.byte() != property_id:
+            raise ArchiveFormatError(
+                "unexpected header structure at {}".format(self.pos - 1))
+
+
+class _7zFolder(object):
+    """A 7z folder, i.e. the coders applied to packed streams"""
+
+    def __init__(self, reader):
+        self.coders = []
+        num_in = num_out = 0
+        for _ in range(reader.number()):
+            flags = reader.byte()
+            if flags & 0x80:
+                raise ArchiveFormatError("alternative coders not supported")
+            coder_id = reader.bytes(flags & 0x0F)
+            coder_in = coder_out = 1
+            if flags & 0x10:
+                coder_in = reader.number()
+                coder_out = reader.number()
+            props = reader.bytes(reader.number()) if flags & 0x20 else b''
+            self.coders.append((coder_id, props))
+            num_in += coder_in
+            num_out += coder_out
+        bound_out = set()
+        for _ in range(num_out - 1):
+            reader.number()  # in index
+            bound_out.add(reader.number())
+        self.num_packed_streams = num_in - (num_out - 1)
+        if self.num_packed_streams > 1:
+            for _ in range(self.num_packed_streams):
+                reader.number()
+        self.num_out = num_out
+        # the folder's output is the one out stream, that's not bound to
+        # another coder
+        self.main_out = [i for i in range(num_out) if i not in bound_out][0]
+        self.unpack_sizes = []
+        self.unpack_size = None
+        self.has_crc = False
+        self.pack_offset = None
+        self.pack_size = None
+        self.num_substreams = 1
+        self.substream_sizes = []
+
+    @property
+    def is_copy(self):
+        return len(self.coders) == 1 and self.coders[0][0] == _7Z_COPY
+
+    def decode(self, data):
+        """Decode (header) data packed by this folder"""
+        if len(self.coders) != 1:
+            raise ArchiveFormatError("unsupported header coders")
+        coder_id, props = self.coders[0]
+        if coder_id == _7Z_COPY:
+            return data[:self.unpack_size]
+        elif coder_id == _7Z_LZMA and len(props) == 5:
+            d = props[0]
+            lzma_filter = dict(id=lzma.FILTER_LZMA1,
+                               lc=d % 9, lp=(d // 9) % 5, pb=d // 45,
+                               dict_size=int.from_bytes(props[1:5], 'little'))
+        elif coder_id == _7Z_LZMA2 and len(props) == 1:
+            lzma_filter = dict(id=lzma.FILTER_LZMA2,
+                               dict_size=(2 | (props[0] & 1))
+                               << (props[0] // 2 + 11))
+        else:
+            raise ArchiveFormatError("unsupported header coder")
+        decompressor = lzma.LZMADecompressor(format=lzma.FORMAT_RAW,
+                                             filters=[lzma_filter])
+        try:
+            return decompressor.decompress(data, max_length=self.unpack_size)
+        except lzma.LZMAError as e:
+            raise ArchiveFormatError(str(e))
+
+
+def _read_7z_streams_info(reader, pack_base):
+    """Read a 7z StreamsInfo structure
+
+    :returns: list of _7zFolder with their absolute pack offset, unpack size
+      and substream sizes assigned
+    """
+    pack_sizes = []
+    folders = []
+    property_id = reader.byte()
+    if property_id == _7Z_PACK_INFO:
+        pack_pos = reader.number()
+        num_pack_streams = reader.number()
+        property_id = reader.byte()
+        while property_id != _7Z_END:
+            if property_id == _7Z_SIZE:
+                pack_sizes = [reader.number()
+                              for _ in range(num_pack_streams)]
+            elif property_id == _7Z_CRC:
+                reader.skip_digests(num_pack_streams)
+            else:
+                raise ArchiveFormatError("unexpected pack info")
+            property_id = reader.byte()
+        property_id = reader.byte()
+    else:
+        pack_pos = 0
+
+    if property_id == _7Z_UNPACK_INFO:
+        reader.expect(_7Z_FOLDER)
+        num_folders = reader.number()
+        if reader.byte():
+            raise ArchiveFormatError("external folders not supported")
+        folders = [_7zFolder(reader) for _ in range(num_folders)]
+        reader.expect(_7Z_CODERS_UNPACK_SIZE)
+        for folder in folders:
+            folder.unpack_sizes = [reader.number()
+                                   for _ in range(folder.num_out)]
+            folder.unpack_size = folder.unpack_sizes[folder.main_out]
+        property_id = reader.byte()
+        while property_id != _7Z_END:
+            if property_id == _7Z_CRC:
+                defined = reader.defined_bits(num_folders)
+                reader.bytes(4 * sum(defined))
+                for folder, has_crc in zip(folders, defined):
+                    folder.has_crc = has_crc
+            else:
+                raise ArchiveFormatError("unexpected unpack info")
+            property_id = reader.byte()
+        property_id = reader.byte()
+
+    # assign pack stream positions to folders
+    offset = pack_base + pack_pos
+    stream = 0
+    for folder in folders:
+        folder.pack_offset = offset
+        if stream + folder.num_packed_streams > len(pack_sizes):
+            raise ArchiveFormatError("missing pack streams")
+        folder.pack_size = sum(
+            pack_sizes[stream:stream + folder.num_packed_streams])
+        offset += folder.pack_size
+        stream += folder.num_packed_streams
+        folder.substream_sizes = [folder.unpack_size]
+
+    if property_id == _7Z_SUBSTREAMS_INFO:
+        property_id = reader.byte()
+        if property_id == _7Z_NUM_UNPACK_STREAM:
+            for folder in folders:
+                folder.num_substreams = reader.number()
+            property_id = reader.byte()
+        if property_id == _7Z_SIZE:
+            for folder in folders:
+                if not folder.num_substreams:
+                    folder.substream_sizes = []
+                    continue
+                sizes = [reader.number()
+                         for _ in range(folder.num_substreams - 1)]
+                sizes.append(folder.unpack_size - sum(sizes))
+                folder.substream_sizes = sizes
+            property_id = reader.byte()
+        else:
+            for folder in folders:
+                folder.substream_sizes = \
+                    [folder.unpack_size] if folder.num_substreams else []
+        if property_id == _7Z_CRC:
+            # digests of streams, whose CRC isn't known from the folder
+            reader.skip_digests(sum(
+                f.num_substreams for f in folders
+                if f.num_substreams != 1 or not f.has_crc))
+            property_id = reader.byte()
+        if property_id != _7Z_END:
+            raise ArchiveFormatError("unexpected substreams info")
+        property_id = reader.byte()
+
+    if property_id != _7Z_END:
+        raise ArchiveFormatError("unexpected streams info")
+    return folders
+
+
+def _read_7z_files_info(reader):
+    """Read 7z FilesInfo
+
+    :returns: list of (name, has_stream, is_dir) tuples
+    """
+    num_files = reader.number()
+    empty_stream = [False] * num_files
+    empty_file = []
+    names = None
+    while True:
+        property_id = reader.byte()
+        if property_id == _7Z_END:
+            break
+        size = reader.number()
+        end = reader.pos + size
+        if property_id == _7Z_EMPTY_STREAM:
+            empty_stream = reader.bits(num_files)
+        elif property_id == _7Z_EMPTY_FILE:
+            empty_file = reader.bits(sum(empty_stream))
+        elif property_id == _7Z_NAME:
+            if reader.byte():
+                raise ArchiveFormatError("external names not supported")
+            names = reader.bytes(end - reader.pos).decode(
+                'utf-16-le', 'surrogatepass').split('\x00')[:num_files]
+        reader.pos = end
+
+    if names is None or len(names) != num_files:
+        raise ArchiveFormatError("missing file names")
+    files = []
+    empty_index = 0
+    for name, is_empty_stream in zip(names, empty_stream):
+        is_dir = False
+        if is_empty_stream:
+            is_dir = not (empty_index < len(empty_file) and
+                          empty_file[empty_index])
+            empty_index += 1
+        files.append((name, not is_empty_stream, is_dir))
+    return files
+
+
+def _iter_7z_substreams(folders):
+    """Yield (size, offset) of all substreams of the given folders
+
+    The offset is only known for uncompressed folders and None otherwise.
+    """
+    for folder in folders:
+        offset = folder.pack_offset if folder.is_copy else None
+        for size in folder.substream_sizes:
+            yield size, offset
+            if offset is not None:
+                offset += size
+
+
+def read_7z_headers(archive_path):
+    """Get all file members of a 7z archive by reading its headers
+
+    Data offsets are determined for members, that are stored uncompressed
+    (copy method, as created by `7z -mx0`).
+
+    :param archive_path: Path
+    :returns: dict mapping member paths to `ArchiveMember`
+    :raises: ArchiveFormatError, OSError
+    """
+    with open(str(archive_path), 'rb') as f:
+        start_header = f.read(32)
+        if len(start_header) != 32 or \
+                not start_header.startswith(_7Z_SIGNATURE):
+            raise ArchiveFormatError("not a 7z archive")
+        next_offset = int.from_bytes(start_header[12:20], 'little')
+        next_size = int.from_bytes(start_header[20:28], 'little')
+        if not next_size:
+            # empty archive
+            return dict()
+        f.seek(32 + next_offset)
+        header = f.read(next_size)
+        if len(header) != next_size or \
+                zlib.crc32(header) != int.from_bytes(start_header[28:32],
+                                                     'little'):
+            raise ArchiveFormatError("corrupt header")
+
+        reader = _7zHeaderReader(header)
+        property_id = reader.byte()
+        while property_id == _7Z_ENCODED_HEADER:
+            # the actual header is packed like any other stream
+            folders = _read_7z_streams_info(reader, 32)
+            if len(folders) != 1:
+                raise ArchiveFormatError("unsupported encoded header")
+            f.seek(folders[0].pack_offset)
+            reader = _7zHeaderReader(
+                folders[0].decode(f.read(folders[0].pack_size)))
+            property_id = reader.byte()
+
+    if property_id != _7Z_HEADER:
+        raise ArchiveFormatError("unexpected header")
+
+    folders = []
+    files = []
+    property_id = reader.byte()
+    if property_id == _7Z_ARCHIVE_PROPERTIES:
+        while reader.byte() != _7Z_END:
+            reader.bytes(reader.number())
+        property_id = reader.byte()
+    if property_id == _7Z_ADDITIONAL_STREAMS_INFO:
+        _read_7z_streams_info(reader, 32)
+        property_id = reader.byte()
+    if property_id == _7Z_MAIN_STREAMS_INFO:
+        folders = _read_7z_streams_info(reader, 32)
+        property_id = reader.byte()
+    if property_id == _7Z_FILES_INFO:
+        files = _read_7z_files_info(reader)
+        property_id = reader.byte()
+    if property_id != _7Z_END:
+        raise ArchiveFormatError("unexpected header")
+
+    # members with data are assigned to the substreams of the folders in
+    # order of appearance
+    substreams = _iter_7z_substreams(folders)
+    members = dict()
+    for name, has_stream, is_dir in files:
+        if is_dir:
+            continue
+        if has_stream:
+            try:
+                size, offset = next(substreams)
+            except StopIteration:
+                raise ArchiveFormatError("missing streams")
+        else:
+            # empty file; any position within the archive provides its
+            # (zero) bytes
+            size, offset = 0, 0
+        members[name] = ArchiveMember(size=size, offset=offset)
+    return members
+
+
+def list_archive(archive_path):
+    """Get all file members of a 7z archive
+
+    Headers are read directly if possible. Otherwise (e.g. encrypted headers)
+    this falls back to a listing by 7z itself, which doesn't provide data
+    offsets.
+
+    :param archive_path: Path
+    :returns: dict mapping member paths to `ArchiveMember`
+    :raises: subprocess.CalledProcessError, OSError
+    """
+    try:
+        return read_7z_headers(archive_path)
+    except ArchiveFormatError:
+        pass
+
+    res = subprocess.run(['7z', 'l', '-slt', str(archive_path)],
+                         stdout=subprocess.PIPE,
+                         stderr=subprocess.DEVNULL,
+                         check=True)
+    # technical listing: properties of the archive itself, followed by a
+    # separator line and a block of "Property = Value" lines per member
+    listing = res.stdout.decode('utf-8', 'surrogateescape')
+    listing = listing.partition('\n----------\n')[2]
+    members = dict()
+    for block in listing.split('\n\n'):
+        props = dict(line.partition(' = ')[::2]
+                     for line in block.splitlines())
+        if 'Path' not in props or props.get('Folder') == '+' or \
+                props.get('Attributes', '').startswith('D'):
+            # not a member or a directory
+            continue
+        size = props.get('Size')
+        members[props['Path']] = ArchiveMember(
+            size=int(size) if size and size.isdigit() else None,
+            offset=None)
+    return members
+
+
+class ArchiveIndex(object):
+    """Member listing of an archive
+
+    An index is valid as long as the archive file's signature (device, inode,
+    size, mtime) doesn't change.
+    """
+
+    def __init__(self, archive_path, signature):
+        """
+
+        :param archive_path: Path
+        :param signature: tuple as returned by `file_signature()` for the
+            archive at the time of reading it
+        """
+        self.archive_path = archive_path
+        self.signature = signature
+        self.members = list_archive(archive_path)
+
+    def __contains__(self, member):
+        return member in self.members
+
+    def __len__(self):
+        return len(self.members)
+
+    def get(self, member):
+        return self.members.get(member)
+
+
+_archive_indices = LRUCache(ARCHIVE_INDEX_CACHE_SIZE)
+# serialize (re-)building of an archive's index, so a burst of requests
+# against a not yet indexed archive doesn't result in a burst of 7z processes
+_archive_index_locks = KeyLocks()
+
+
+def get_archive_index(archive_path):
+    """Get the index of an archive, (re-)building it if needed
+
+    :param archive_path: Path
+    :returns: ArchiveIndex or None if there's no (readable) archive
+    """
+    cache_key = str(archive_path)
+    try:
+        signature = file_signature(os.stat(cache_key))
+    except OSError:
+        # no archive, no index
+        _archive_indices.pop(cache_key)
+        return None
+
+    index = _archive_indices.get(cache_key)
+    if index is not None and index.signature == signature:
+        return index
+
+    with _archive_index_locks(cache_key):
+        # might have been built while we were waiting
+        index = _archive_indices.get(cache_key)
+        if index is not None and index.signature == signature:
+            return index
+        try:
+            index = ArchiveIndex(archive_path, signature)
+        except (subprocess.CalledProcessError, OSError):
+            # - if we can't run that, we don't have access
+            # - includes missing 7z executable
+            _archive_indices.pop(cache_key)
+            return None
+        _archive_indices.put(cache_key, index)
+    return index
+
+
+class ArchiveManifest(object):
+    """Mapping of archive members to the archive shards containing them
+
+    A manifest is valid as long as the file's signature doesn't change.
+    """
+
+    def __init__(self, manifest_path, signature):
+        """
+
+        :param manifest_path: Path
+        :param signature: tuple as returned by `file_signature()` for the
+            manifest at the time of reading it
+        """
+        self.signature = signature
+        self.shards = read_archive_manifest(manifest_path)
+
+    def get(self, member):
+        """Get the file name of the shard containing `member` or None
+        """
+        return self.shards.get(member)
+
+
+def read_archive_manifest(manifest_path):
+    """
+
+    :param manifest_path: Path
+    :returns: dict
+      mapping member paths to shard file names
+    """
+    shards = dict()
+    shard = None
+    with open(str(manifest_path)) as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if not line or line.startswith('#'):
+                continue
+            if line.startswith('['):
+                # shared by all its members
+                shard = sys.intern(line[1:-1])
+            elif shard is not None:
+                shards[line] = shard
+    return shards
+
+
+_archive_manifests = LRUCache(ARCHIVE_INDEX_CACHE_SIZE)
+
+
+def get_archive_manifest(manifest_path):
+    """Get the (cached) manifest of a dataset's archive shards
+
+    :param manifest_path: Path
+    :returns: ArchiveManifest or None if there are no (readable) shards
+    """
+    cache_key = str(manifest_path)
+    try:
+        signature = file_signature(os.stat(cache_key))
+    except OSError:
+        _archive_manifests.pop(cache_key)
+        return None
+    manifest = _archive_manifests.get(cache_key)
+    if manifest is None or manifest.signature != signature:
+        try:
+            manifest = ArchiveManifest(manifest_path, signature)
+        except (OSError, UnicodeDecodeError):
+            _archive_manifests.pop(cache_key)
+            return None
+        _archive_manifests.put(cache_key, manifest)
+    return manifest
+
+
+class DatasetDescriptor(object):
+    """Layout of a dataset's representation in a store
+
+    This is read from the dataset directory and assumed to be valid as long as
+    the directory's mtime doesn't change (for up to `DATASET_CACHE_TTL`
+    seconds).
+    """
+
+    def __init__(self, ds_dir, mtime):
+        """
+
+        :param ds_dir: Path
+        :param mtime: int
+          mtime (ns) of `ds_dir` at the time of reading it
+        """
+        self.ds_dir = ds_dir
+        self.mtime = mtime
+        self.timestamp = time.monotonic()
+        # A modification within the same timestamp granularity as the reading
+        # wouldn't be detectable by the mtime (cf. "racy git"). Don't trust a
+        # recently modified directory's mtime.
+        self.racy = time.time_ns() - mtime < 2 * 10 ** 9
+        self.layout_version = \
+            (ds_dir / 'ria-layout-version').read_text().strip().split('|')[0]
+        self.objects_dir = ds_dir / 'annex' / 'objects'
+        self.archives_dir = ds_dir / 'archives'
+        self.archive_path = self.archives_dir / 'archive.7z'
+        self.manifest_path = self.archives_dir / ARCHIVE_MANIFEST
+        # Note, that (re-)creating the archives directory changes the
+        # dataset directory's mtime, while creating the archive itself doesn't.
+        # Hence, only the former is cached.
+        self.has_archives = self.archives_dir.is_dir()
+
+    def archive_for(self, member):
+        """Get the archive that would contain `member`
+
+        This is the shard listed for it in the manifest, if any, and
+        archive.7z otherwise.
+
+        :param member: str
+          object path
+        :returns: Path
+        """
+        manifest = get_archive_manifest(self.manifest_path) \
+            if self.has_archives else None
+        shard = manifest.get(member) if manifest is not None else None
+        return self.archives_dir / shard if shard else self.archive_path
+
+
+_dataset_descriptors = LRUCache(DATASET_CACHE_SIZE)
+
+
+def get_dataset_descriptor(ds_dir):
+    """Get the (cached) descriptor of a dataset
+
+    :param ds_dir: Path
+    :returns: DatasetDescriptor
+    :raises: OSError if there's no (readable) dataset at `ds_dir`
+    """
+    cache_key = str(ds_dir)
+    mtime = os.stat(cache_key).st_mtime_ns
+    descriptor = _dataset_descriptors.get(cache_key)
+    if descriptor is None or descriptor.racy or descriptor.mtime != mtime or \
+            time.monotonic() - descriptor.timestamp > DATASET_CACHE_TTL:
+        descriptor = DatasetDescriptor(ds_dir, mtime)
+        _dataset_descriptors.put(cache_key, descriptor)
+    return descriptor
+
+
+def _non_chunk_key(key):
+    # key without chunk size and number fields (-S, -C)
+    fields, sep, rest = key.partition('--')
+    fields = fields.split('-')
+    return '-'.join(fields[:1] + [f for f in fields[1:]
+                                  if f[:1] not in ('S', 'C')]) + sep + rest
+
+
+_DIRHASH_CHARS = '0123456789zqjxkmvwgpfZQJXKMVWGPF'
+
+
+def dirhash_mixed(key):
+    """git-annex' dirhashmixed of a key, e.g. 'pX/Zw'
+
+    See https://git-annex.branchable.com/internals/hashing/
+    """
+    md5 = hashlib.md5(_non_chunk_key(key).encode()).digest()
+    word = int.from_bytes(md5[:4], 'little')
+    c = [_DIRHASH_CHARS[(word >> (6 * i)) & 31] for i in range(4)]
+    return '{}{}/{}{}'.format(c[1], c[0], c[3], c[2])
+
+
 class AnnexObject(object):
     """
 
     """
 
-    def __init__(self, request_path, path_prefix):
+    def __init__(self, request_path, path_prefix, request_metrics=None):
         """
 
         :param request_path:
         :param path_prefix:
+        :param request_metrics: RequestMetrics or None
+          to record the timing of lookups in
+        """
+        self.request_metrics = request_metrics or RequestMetrics()
+        with self.request_metrics.phase('resolve'):
+            path_prefix = Path(path_prefix)
+
+            uri_parts = request_path.split('/')
+            # Note, that uri_parts[1:-6] derives from:
+            # - URI has to start with '/', therefore split() results starts
+            #   with empty string
+            # - 6 substracted levels:
+            #   annex/objects/tree_1/tree_2/key_dir/key_file
+            ds_dir = path_prefix.joinpath(*uri_parts[1:-6])
+        with self.request_metrics.phase('layout'):
+            dataset = get_dataset_descriptor(ds_dir)
+        # the URI is supposed to be dirhashmixed already
+        self._setup(dataset,
+                    uri_parts[-1],
+                    lambda: Path(uri_parts[-4]).joinpath(*uri_parts[-3:]))
+
+    @classmethod
+    def from_key(cls, dataset, key, archive_path=None):
+        """Get the object for a key in a dataset (rather than a request)
+
+        :param dataset: DatasetDescriptor
+        :param key: str
+        :param archive_path: Path or None
+          archive (shard) to look for the key in, rather than the one the
+          dataset's manifest assigns it to (e.g. to read every archived copy
+          of a key)
         """
-        path_prefix = Path(path_prefix)
+        key_object = cls.__new__(cls)
+        key_object.request_metrics = RequestMetrics()
+        key_object._setup(dataset, key,
+                          lambda: Path(dirhash_mixed(key), key, key))
+        key_object._archive_path = archive_path
+        return key_object
 
-        uri_parts = request_path.split('/')
-        self.key = uri_parts[-1]
-        # Note, that uri_parts[1:-6] derives from:
-        # - URI has to start with '/', therefore split() results starts with
-        #   empty string
-        # - 6 substracted levels: annex/objects/tree_1/tree_2/key_dir/key_file
-        ds_dir = path_prefix.joinpath(*uri_parts[1:-6])
+    def _setup(self, dataset, key, mixed_path):
+        """
 
-        self.archive_path = ds_dir / 'archives' / 'archive.7z'
+        :param dataset: DatasetDescriptor
+        :param key: str
+        :param mixed_path: callable
+          returning the key's dirhashmixed object path; only called if the
+          dataset's layout requires it
+        """
+        self.key = key
+        self.dataset = dataset
+        self._archive_path = None
 
         # We need to figure where to actually look for a key file. Currently a
         # dataset may use dirhashlower or dirhashmixed to build its
         # annex/objects tree.
         # See https://git-annex.branchable.com/internals/hashing/
-        ds_layout_version = \
-            (ds_dir / 'ria-layout-version').read_text().strip().split('|')[0]
+        ds_layout_version = dataset.layout_version
         if ds_layout_version == '1':
             # dataset representation uses dirhashlower
             md5 = hashlib.md5(self.key.encode()).hexdigest()
             self.object_path = Path(md5[:3]) / md5[3:] / self.key / self.key
-            self.file_path = ds_dir / 'annex' / 'objects' / self.object_path
 
         elif ds_layout_version == '2':
-            # dataset representation uses dirhashmixed; this is what we expect
-            # the original URI to be already. Note, that URI is absolute while
-            # we need to look at it as a relative path.
-            self.file_path = path_prefix.joinpath(*uri_parts[1:])
-            self.object_path = Path(uri_parts[-4]).joinpath(*uri_parts[-3:])
+            # dataset representation uses dirhashmixed
+            self.object_path = mixed_path()
         else:
             # TODO: Proper status
             raise ValueError("layout: %s" % ds_layout_version)
+        self.file_path = dataset.objects_dir / self.object_path
 
         self._exists = None
+        self._stat = None
         self._in_archive = None
 
+    @property
+    def archive_path(self):
+        """The archive (shard) that would contain the key
+        """
+        if self._archive_path is None:
+            self._archive_path = self.dataset.archive_for(
+                str(self.object_path))
+        return self._archive_path
+
     def in_archive(self):
 
         def check_archive():
-            if not self.archive_path.exists():
-                # no archive, no file
-                return False
-            # TODO: ultimately those paths come from user input (the request).
-            #       What exactly do we need to make sure at this point wrt
-            #       security?
-            loc = str(self.object_path)
-            arc = str(self.archive_path)
-
-            try:
-                res = subprocess.run(['7z', 'l', arc, loc],
-                                     stdout=subprocess.PIPE,
-                                     check=True)
-            except subprocess.CalledProcessError:
-                # - if we can't run that, we don't have access
-                # - includes missing 7z executable
+            if not self.dataset.has_archives:
                 return False
-
-            return loc in res.stdout.decode()
+            # no (readable) archive, no file
+            # Note, that the object path derives from user input (the
+            # request), but it's merely looked up in the archive's index.
+            return self.archive_member() is not None
 
         # store result; note that within this script we respond to a single
         # request
         if self._in_archive is None:
-            self._in_archive = check_archive()
+            with self.request_metrics.phase('archive_check'):
+                self._in_archive = check_archive()
         return self._in_archive
 
+    def archive_member(self):
+        """Get the key's `ArchiveMember` or None, if it's not in the archive
+        """
+        index = get_archive_index(self.archive_path)
+        return index.get(str(self.object_path)) if index is not None else None
+
     def in_object_tree(self):
 
         # store result; note that within this script we respond to a single
         # request
         if self._exists is None:
-            self._exists = self.file_path.exists()
+            with self.request_metrics.phase('tree_stat'):
+                try:
+                    self._stat = self.file_path.stat()
+                    self._exists = True
+                except OSError:
+                    self._exists = False
         return self._exists
 
     def is_present(self):
@@ -127,19 +1707,96 @@ class AnnexObject(object):
 
         return self.in_object_tree() or self.in_archive()
 
-    def get(self):
+    def open(self, offset=0, length=None, source=None, use_cache=True):
+        """Open the key's content for reading, unless it requires extraction
 
-        if self.in_object_tree():
-            return self.file_path.open('rb')
-        elif self.in_archive():
-            res = subprocess.Popen(['7z', 'x', '-so',
-                                    str(self.archive_path),
-                                    str(self.object_path)],
-                                   stdout=subprocess.PIPE)
-            return res.stdout
+        :param offset: int
+          Number of bytes to skip from the start of the content
+        :param length: int or None
+          Max. number of bytes to read; no limit if None
+        :param source: str or None
+          'tree' or 'archive' to only consider the copy there; the object
+          tree is preferred if None
+        :param use_cache: bool
+          Whether an archived copy may be read from the extraction cache
+        :returns: binary file-like or ArchiveExtraction
+          An extraction from the archive isn't started yet.
+        """
+
+        if source != 'archive' and self.in_object_tree():
+            self.request_metrics.source = 'tree'
+            f = self.file_path.open('rb')
+            if offset or length is not None:
+                f = ObjectStream(f, offset, length)
+            return f
+        elif source != 'tree' and self.in_archive():
+            member = self.archive_member()
+            if member is not None and member.offset is not None:
+                # stored uncompressed; serve the slice of the archive file
+                # directly
+                self.request_metrics.source = 'archive'
+                if length is None or length > member.size - offset:
+                    length = max(member.size - offset, 0)
+                return ObjectStream(self.archive_path.open('rb'),
+                                    member.offset + offset, length)
+            if use_cache and extraction_cache is not None:
+                f = extraction_cache.open(self.archive_path,
+                                          str(self.object_path),
+                                          offset, length)
+                if f is not None:
+                    self.request_metrics.source = 'cache'
+                    return f
+            self.request_metrics.source = 'extraction'
+            return ArchiveExtraction(self.archive_path, str(self.object_path),
+                                     offset, length,
+                                     size=member.size if member else None)
         else:
             raise KeyNotFoundError
 
+    def get(self, offset=0, length=None, source=None, use_cache=True):
+        """Open the key's content for reading
+
+        Parameters as for `open()`.
+
+        :returns: binary file-like
+        """
+        f = self.open(offset, length, source, use_cache)
+        if isinstance(f, ArchiveExtraction):
+            f = f.start()
+        return f
+
+    def etag(self):
+        """Strong entity tag of the key's content
+
+        Keys are content-addressed, so the key itself identifies the content.
+        """
+        return '"{}"'.format(self.key)
+
+    def last_modified(self):
+        """Modification time of the file providing the key's content
+
+        This relies on information already gathered by the presence checks.
+
+        :returns: float or None
+        """
+        if self.in_object_tree():
+            return self._stat.st_mtime
+        index = get_archive_index(self.archive_path) \
+            if self.in_archive() else None
+        return index.signature[3] / 10 ** 9 if index is not None else None
+
+    def tree_size(self):
+        """Size of the file providing the key's content in the object tree
+
+        Unlike `size()`, this is the actual size of the file rather than the
+        one recorded in the key. It relies on information already gathered by
+        the presence checks.
+
+        :returns: int or None
+          None if the key isn't in the object tree
+        """
+        return self._stat.st_size if self.in_object_tree() else None
+
     def size(self):
 
         # see: https://git-annex.branchable.com/internals/key_format/
@@ -171,10 +1828,1025 @@ class AnnexObject(object):
             raise ValueError("invalid key: {}".format(self.key))
 
 
-def application(environ, start_response):
+def if_range_matches(environ, key_object):
+    """Whether a Range request's If-Range precondition (if any) holds
+
+    :param environ: dict
+    :param key_object: AnnexObject
+    :returns: bool
+    """
+    validator = environ.get('HTTP_IF_RANGE', '').strip()
+    if not validator:
+        return True
+    if validator.startswith(('"', 'W/')):
+        # entity tag; If-Range requires strong comparison
+        return validator == key_object.etag()
+    # HTTP-date: The content behind a key never changes, so whatever a client
+    # got at any time is still the same representation.
+    return True
+
+
+def read_keylist(environ):
+    """Read a whitespace-separated list of keys from a request's body
+
+    :param environ: dict
+    :returns: list of str
+    :raises: ValueError if the body exceeds `MAX_KEYLIST_SIZE`
+    """
+    try:
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        length = 0
+    if length > MAX_KEYLIST_SIZE:
+        raise ValueError("key list too large")
+    body = environ['wsgi.input'].read(length) if length > 0 else b''
+    return body.decode('utf-8', 'surrogateescape').split()
+
+
+def scan_object_tree(objects_dir):
+    """Get all keys, that have a file in an object tree
+
+    :param objects_dir: Path
+    :returns: set of str
+    """
+
+    def entries(paths, dirs=True):
+        for path in paths:
+            try:
+                with os.scandir(path) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False) == dirs:
+                            yield entry
+            except OSError:
+                # vanished or not readable
+                continue
+
+    # tree_1/tree_2/key_dir/key_file
+    tree_1 = (e.path for e in entries([str(objects_dir)]))
+    tree_2 = (e.path for e in entries(tree_1))
+    key_dirs = (e.path for e in entries(tree_2))
+    return set(e.name for e in entries(key_dirs, dirs=False)
+               if e.name == os.path.basename(os.path.dirname(e.path)))
+
+
+def locate_keys(dataset, keys):
+    """Locate a number of keys in a dataset
+
+    Archive indices and (for large numbers of keys) a single listing of the
+    object tree are shared by all keys.
+
+    :param dataset: DatasetDescriptor
+    :param keys: list of str
+    :returns: generator of (key, location, size) tuples; `location` is 'tree',
+      'archive' or None, if the key isn't present. `size` is None if unknown.
+    """
+    # archive path -> index
+    indices = dict()
+    tree_keys = scan_object_tree(dataset.objects_dir) \
+        if len(keys) > TREE_SCAN_THRESHOLD else None
+
+    for key in keys:
+        if not key or key.startswith('.') or '/' in key:
+            # not a key, but possibly an attempt to escape the dataset
+            yield key, None, None
+            continue
+        if presence_index is not None and \
+                presence_index.absent(dataset.ds_dir, key):
+            yield key, None, None
+            continue
+        key_object = AnnexObject.from_key(dataset, key)
+        member = None
+        if key in tree_keys if tree_keys is not None \
+                else key_object.in_object_tree():
+            location = 'tree'
+        elif dataset.has_archives:
+            archive_path = key_object.archive_path
+            if archive_path not in indices:
+                indices[archive_path] = get_archive_index(archive_path)
+            index = indices[archive_path]
+            member = index.get(str(key_object.object_path)) \
+                if index is not None else None
+            location = 'archive' if member is not None else None
+        else:
+            location = None
+        size = None
+        if location:
+            try:
+                size = key_object.size()
+            except ValueError:
+                # invalid key
+                pass
+            if size is None and member is not None:
+                size = member.size
+        yield key, location, size
+
+
+class BloomFilter(object):
+    """Compact set of strings, that may report false positives, but no false
+    negatives
+    """
+
+    def __init__(self, capacity, error_rate=PRESENCE_INDEX_ERROR_RATE):
+        """
+
+        :param capacity: int
+          number of items to be added
+        :param error_rate: float
+          false positive rate once `capacity` items were added
+        """
+        capacity = max(capacity, 1)
+        # optimal number of bits and hash functions for that rate
+        self.size = max(64, int(-capacity * math.log(error_rate) /
+                                math.log(2) ** 2))
+        self.hashes = min(max(1, round(self.size / capacity * math.log(2))),
+                          16)
+        self.bits = bytearray((self.size + 7) // 8)
+
+    @classmethod
+    def from_items(cls, items):
+        items = list(items)
+        bloom = cls(len(items))
+        for item in items:
+            bloom.add(item)
+        return bloom
+
+    def _positions(self, item):
+        # k positions from two hashes (Kirsch/Mitzenmacher)
+        digest = hashlib.blake2b(item.encode('utf-8', 'surrogateescape'),
+                                 digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        for p in self._positions(item):
+            self.bits[p >> 3] |= 1 << (p & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[p >> 3] & (1 << (p & 7))
+                   for p in self._positions(item))
+
+
+def _scandir(path):
+    # entries of a directory; none if it vanished or isn't readable
+    try:
+        with os.scandir(path) as it:
+            return list(it)
+    except OSError:
+        return []
+
+
+class _IndexedDataset(object):
+    """Filters of the keys present in a dataset, see `PresenceIndex`
+    """
+
+    def __init__(self, layout_version):
+        self.layout_version = layout_version
+        # Per first level directory of the object tree and per archive file
+        # name: (signature, BloomFilter). A signature of None means, that the
+        # filter needs to be rebuilt on the next scan.
+        self.tree = dict()
+        self.archives = dict()
+        # mtime of the archives directory (-1 if there's none), to tell
+        # whether archives were added or removed; None if unknown
+        self.archives_mtime = None
+
+    def _tree_dirs(self, key):
+        # first and second level directory of the key in the object tree
+        if self.layout_version == '1':
+            md5 = hashlib.md5(key.encode()).hexdigest()
+            return md5[:3], md5[3:]
+        return tuple(dirhash_mixed(key).split('/'))
+
+    def __contains__(self, key):
+        segment = self.tree.get(self._tree_dirs(key)[0])
+        return (segment is not None and key in segment[1]) or \
+            any(key in bloom for _, bloom in self.archives.values())
+
+    def is_current(self, ds_dir, key):
+        """Whether the filters still apply to a key
+
+        Checks (by a few stat() calls), that neither the part of the object
+        tree the key would be in, nor the archives changed since the scan.
+
+        :param ds_dir: Path
+        :param key: str
+        :returns: bool
+        """
+        tree_1, tree_2 = self._tree_dirs(key)
+        segment = self.tree.get(tree_1)
+        tree_1_dir = ds_dir / 'annex' / 'objects' / tree_1
+        mtimes = []
+        try:
+            # adding a key changes the mtime of its tree_2 directory, adding
+            # that one the mtime of tree_1
+            mtimes.append(tree_1_dir.stat().st_mtime_ns)
+            mtimes.append((tree_1_dir / tree_2).stat().st_mtime_ns)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            return False
+        if segment is None:
+            # no such directory when scanned
+            if mtimes:
+                return False
+        elif segment[0] is None or \
+                max(mtimes, default=0) > segment[0][1]:
+            return False
+
+        archives_dir = ds_dir / 'archives'
+        try:
+            archives_mtime = archives_dir.stat().st_mtime_ns
+        except FileNotFoundError:
+            archives_mtime = -1
+        except OSError:
+            return False
+        if self.archives_mtime is None or \
+                archives_mtime != self.archives_mtime:
+            return False
+        for name, (signature, _) in self.archives.items():
+            try:
+                if signature is None or file_signature(
+                        (archives_dir / name).stat()) != signature:
+                    return False
+            except OSError:
+                return False
+        return True
+
+
+class PresenceIndex(object):
+    """Filters of the keys present in each dataset of a store
+
+    A key not in a dataset's filters was absent from the dataset as of the
+    last scan. Scans run periodically in a thread and are incremental: Only
+    the parts of object trees (first level directories) and the archives, that
+    changed since the previous scan, are read again. Before a key is reported
+    absent, the part of the object tree it would be in and the archives are
+    checked to not have changed since.
+    """
+
+    # archive.7z and its shards
+    ARCHIVE_PATTERN = re.compile(r'^archive(-\d{4,})?\.7z$')
+
+    def __init__(self, store_dir):
+        """
+
+        :param store_dir: Path
+        """
+        self.store_dir = store_dir
+        # dataset directory -> _IndexedDataset
+        self.datasets = dict()
+        self._scanner = None
+        self._lock = threading.Lock()
+
+    def absent(self, ds_dir, key):
+        """Whether a key is known to be absent from a dataset
+
+        :param ds_dir: Path
+        :param key: str
+        :returns: bool
+          False if the key may be present or the dataset isn't indexed (yet)
+        """
+        self.start()
+        dataset = self.datasets.get(str(ds_dir))
+        if dataset is None:
+            return False
+        try:
+            # Note, that a key may have been added since the last scan
+            return key not in dataset and \
+                dataset.is_current(Path(ds_dir), key)
+        except UnicodeEncodeError:
+            # not a valid key; let the regular lookup deal with it
+            return False
+
+    def start(self):
+        """Start scanning in this process, unless already done
+
+        Servers may fork processes after importing this module, hence threads
+        are started on demand.
+        """
+        pid = os.getpid()
+        with self._lock:
+            if self._scanner == pid:
+                return
+            self._scanner = pid
+
+        def scan_periodically():
+            while True:
+                try:
+                    self.scan()
+                except Exception:
+                    logger.exception("Failed to scan %s", self.store_dir)
+                time.sleep(PRESENCE_INDEX_INTERVAL)
+
+        threading.Thread(target=scan_periodically, daemon=True).start()
+
+    def scan(self):
+        """Update the filters of all datasets in the store
+        """
+        found = set()
+        for level_1 in _scandir(str(self.store_dir)):
+            if level_1.name.startswith('.') or \
+                    not level_1.is_dir(follow_symlinks=False):
+                continue
+            for level_2 in _scandir(level_1.path):
+                ds_dir = level_2.path
+                try:
+                    dataset = self._scan_dataset(Path(ds_dir),
+                                                 self.datasets.get(ds_dir))
+                except OSError:
+                    # not a dataset (anymore) or not readable
+                    dataset = None
+                if dataset is not None:
+                    self.datasets[ds_dir] = dataset
+                    found.add(ds_dir)
+        for ds_dir in set(self.datasets).difference(found):
+            self.datasets.pop(ds_dir, None)
+
+    def _scan_dataset(self, ds_dir, previous):
+        """
+
+        :param ds_dir: Path
+        :param previous: _IndexedDataset or None
+          result of the previous scan, to reuse unchanged filters from
+        :returns: _IndexedDataset or None
+          None if the dataset's layout isn't supported
+        :raises: OSError if there's no (readable) dataset at `ds_dir`
+        """
+        layout_version = (ds_dir / 'ria-layout-version').read_text() \
+            .strip().split('|')[0]
+        if layout_version not in ('1', '2'):
+            return None
+        dataset = _IndexedDataset(layout_version)
+        if previous is not None and \
+                previous.layout_version != layout_version:
+            previous = None
+        # mtimes closer to now than that may not reflect modifications within
+        # their granularity (cf. DatasetDescriptor.racy)
+        racy_since = time.time_ns() - 2 * 10 ** 9
+
+        # tree_1/tree_2/key_dir/key_file
+        for tree_1 in _scandir(str(ds_dir / 'annex' / 'objects')):
+            if not tree_1.is_dir(follow_symlinks=False):
+                continue
+            tree_2 = [e for e in _scandir(tree_1.path)
+                      if e.is_dir(follow_symlinks=False)]
+            # adding or removing a key changes the mtime of its tree_2
+            # directory (creation or removal of the key directory)
+            mtimes = [e.stat(follow_symlinks=False).st_mtime_ns
+                      for e in tree_2 + [tree_1]]
+            signature = (len(tree_2), max(mtimes))
+            if signature[1] > racy_since:
+                signature = None
+            old = previous.tree.get(tree_1.name) if previous else None
+            if signature is not None and old is not None and \
+                    old[0] == signature:
+                dataset.tree[tree_1.name] = old
+                continue
+            keys = []
+            for key_dir in (k for t in tree_2 for k in _scandir(t.path)):
+                if os.path.isfile(os.path.join(key_dir.path, key_dir.name)):
+                    keys.append(key_dir.name)
+                elif key_dir.is_dir(follow_symlinks=False):
+                    # key file not (yet) moved into place; that doesn't
+                    # change the tree_2 mtime
+                    signature = None
+            dataset.tree[tree_1.name] = (signature,
+                                         BloomFilter.from_items(keys))
+
+        try:
+            archives_mtime = (ds_dir / 'archives').stat().st_mtime_ns
+        except FileNotFoundError:
+            archives_mtime = -1
+        except OSError:
+            archives_mtime = None
+        if archives_mtime is not None and archives_mtime <= racy_since:
+            dataset.archives_mtime = archives_mtime
+        for archive in _scandir(str(ds_dir / 'archives')):
+            if not self.ARCHIVE_PATTERN.match(archive.name):
+                continue
+            signature = file_signature(archive.stat())
+            old = previous.archives.get(archive.name) if previous else None
+            if old is not None and old[0] == signature:
+                dataset.archives[archive.name] = old
+                continue
+            try:
+                members = list_archive(Path(archive.path))
+            except (subprocess.CalledProcessError, OSError):
+                # not readable, so nothing is served from it either; try
+                # again next time
+                members, signature = dict(), None
+            dataset.archives[archive.name] = (
+                signature,
+                BloomFilter.from_items(m.rsplit('/', 1)[-1]
+                                       for m in members))
+        return dataset
+
+
+presence_index = PresenceIndex(Path(PRESENCE_INDEX_STORE)) \
+    if PRESENCE_INDEX_STORE else None
+
+
+class RequestMetrics(object):
+    """Timings and outcome of a single request
+    """
+
+    def __init__(self, method=None, path=None):
+        self.method = method
+        self.path = path
+        self.start = time.monotonic()
+        # phase -> seconds
+        self.phases = Counter()
+        # where the content came from: 'tree', 'archive' (slice of an
+        # uncompressed archive), 'extraction', 'cache' (extraction cache) or
+        # '-' (no content)
+        self.source = '-'
+        self.status = None
+        self.bytes = 0
+        # seconds until the first byte of the body was available
+        self.first_byte = None
+        self.finished = False
+
+    @contextmanager
+    def phase(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phases[name] += time.monotonic() - start
+
+    def sent(self, n):
+        if self.first_byte is None:
+            self.first_byte = time.monotonic() - self.start
+        self.bytes += n
+
+    def finish(self):
+        """Record the request, once it's done (only the first call counts)
+        """
+        if self.finished:
+            return
+        self.finished = True
+        duration = time.monotonic() - self.start
+        if self.first_byte is None:
+            self.first_byte = duration
+        metrics.record(self, duration)
+        if SLOW_REQUEST and duration >= SLOW_REQUEST:
+            logger.warning(
+                "slow request: %s %s -> %s from %s, %d bytes in %.3fs "
+                "(first byte %.3fs; %s)",
+                self.method, self.path, self.status, self.source, self.bytes,
+                duration, self.first_byte,
+                ', '.join('{} {:.3f}s'.format(*p)
+                          for p in sorted(self.phases.items())))
+
+
+class MeteredFile(object):
+    """Binary file-like counting the bytes read from it
+
+    The request is recorded, when it's closed. A server's file_wrapper may send
+    from `fileno()` directly, bypassing `read()`. In that case the expected
+    number of bytes is assumed to be sent.
+    """
+
+    def __init__(self, f, request_metrics, expected_bytes=None):
+        self._f = f
+        self._metrics = request_metrics
+        self._expected = expected_bytes
+        self._closed = False
+
+    def read(self, size=-1):
+        data = self._f.read(size)
+        if data:
+            self._metrics.sent(len(data))
+        return data
+
+    def readinto(self, b):
+        n = self._f.readinto(b)
+        if n:
+            self._metrics.sent(n)
+        return n
+
+    def seekable(self):
+        return False
+
+    def fileno(self):
+        return self._f.fileno()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self._f.close()
+        finally:
+            if not self._metrics.bytes and self._expected:
+                self._metrics.sent(self._expected)
+            self._metrics.finish()
+
+
+def iter_metered(iterable, request_metrics):
+    """Iterate a response body, recording the request when done
+    """
+    try:
+        for chunk in iterable:
+            request_metrics.sent(len(chunk))
+            yield chunk
+    finally:
+        close = getattr(iterable, 'close', None)
+        if close is not None:
+            close()
+        request_metrics.finish()
+
+
+def stream_blocksize(length=None):
+    """Block size for streaming content
+
+    Large blocks save (Python-level) iterations and allocations per byte
+    served, while content smaller than `BLOCKSIZE` is read at once.
+
+    :param length: int or None
+      number of bytes to stream, if known
+    :returns: int
+    """
+    return BLOCKSIZE if length is None else max(min(length, BLOCKSIZE), 1)
+
+
+def iter_file(f, blocksize=BLOCKSIZE):
+    """Iterate a binary file-like blockwise, closing it when done
+    """
+    try:
+        for block in iter(lambda: f.read(blocksize), b''):
+            yield block
+    finally:
+        f.close()
+
+
+class Histogram(object):
+    """Cumulative histogram as exposed by Prometheus
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics(object):
+    """Aggregated request metrics of a server process
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # metric name -> {labels: value}
+        self._counters = {'requests_total': Counter(),
+                          'response_bytes_total': Counter()}
+        self._histograms = {'request_duration_seconds': dict(),
+                            'time_to_first_byte_seconds': dict(),
+                            'request_phase_seconds': dict()}
+        self._lock = threading.Lock()
+
+    def _observe(self, name, labels, value):
+        # under lock
+        histograms = self._histograms[name]
+        if labels not in histograms:
+            histograms[labels] = Histogram(self.buckets)
+        histograms[labels].observe(value)
+
+    def record(self, request_metrics, duration):
+        """
+
+        :param request_metrics: RequestMetrics
+        :param duration: float
+          seconds it took to serve the request
+        """
+        labels = (('method', request_metrics.method or '-'),
+                  ('status', (request_metrics.status or '-').split(' ')[0]),
+                  ('source', request_metrics.source))
+        with self._lock:
+            self._counters['requests_total'][labels] += 1
+            self._counters['response_bytes_total'][labels] += \
+                request_metrics.bytes
+            self._observe('request_duration_seconds', labels, duration)
+            self._observe('time_to_first_byte_seconds', labels,
+                          request_metrics.first_byte)
+            for phase, seconds in request_metrics.phases.items():
+                self._observe('request_phase_seconds', (('phase', phase),),
+                              seconds)
+
+    @staticmethod
+    def _format(name, labels, value, extra=()):
+        labels = labels + extra
+        return '{}{} {}'.format(
+            name,
+            '{' + ','.join('{}="{}"'.format(*label) for label in labels) + '}'
+            if labels else '',
+            value)
+
+    def render(self):
+        """Metrics in the Prometheus text exposition format
+
+        :returns: str
+        """
+        lines = []
+        with self._lock:
+            for name, counter in self._counters.items():
+                name = 'ria_' + name
+                lines.append('# TYPE {} counter'.format(name))
+                lines.extend(self._format(name, labels, value)
+                             for labels, value in sorted(counter.items()))
+            for name, histograms in self._histograms.items():
+                name = 'ria_' + name
+                lines.append('# TYPE {} histogram'.format(name))
+                for labels, h in sorted(histograms.items()):
+                    lines.extend(
+                        self._format(name + '_bucket', labels, count,
+                                     (('le', repr(float(bound))),))
+                        for bound, count in zip(h.buckets, h.counts))
+                    lines.append(self._format(name + '_bucket', labels,
+                                              h.count, (('le', '+Inf'),)))
+                    lines.append(self._format(name + '_sum', labels, h.sum))
+                    lines.append(self._format(name + '_count', labels,
+                                              h.count))
+        lines.append('# TYPE ria_extractions_active gauge')
+        lines.append('ria_extractions_active {}'.format(
+            extraction_slots.active))
+        if extraction_cache is not None:
+            lines.append('# TYPE ria_extraction_cache_bytes gauge')
+            lines.append('ria_extraction_cache_bytes {}'.format(
+                extraction_cache.total))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """Write the metrics to `path` atomically
+        """
+        path = Path(path)
+        temp_path = path.with_name('.' + path.name)
+        temp_path.write_text(self.render())
+        temp_path.replace(path)
+
+
+metrics = Metrics()
+_metrics_writer = None
+
+
+def start_metrics_writer():
+    """Write a server process' metrics to METRICS_DIR periodically
+
+    Servers may fork processes after importing this module, hence threads are
+    started on demand.
+    """
+    global _metrics_writer
+    pid = os.getpid()
+    if not METRICS_DIR or _metrics_writer == pid:
+        return
+    _metrics_writer = pid
+    path = Path(METRICS_DIR) / 'ria_wsgi-{}.prom'.format(pid)
+
+    def write_periodically():
+        while True:
+            time.sleep(METRICS_INTERVAL)
+            try:
+                metrics.write(path)
+            except OSError:
+                logger.exception("Failed to write metrics to %s", path)
+
+    threading.Thread(target=write_periodically, daemon=True).start()
+
+
+def error_response(status, headers=None):
+    """Response with just the status in an HTML body
+
+    :returns: tuple
+      (status, headers, body) as returned by `respond()`
+    """
+    response_body = "<h1>{}</h1>".format(status).encode('utf-8')
+    return (status,
+            [('Content-Type', 'text/html; charset=utf-8'),
+             ('Content-Length', str(len(response_body)))] + (headers or []),
+            [response_body])
+
+
+def server_error_response():
+    """Response to the exception currently being handled
+
+    :returns: tuple
+      (status, headers, body) as returned by `respond()`
+    """
+    # Note: report error class only to not reveal anything internal; details go
+    # to the server's log
+    exctype, value, tb = sys.exc_info()
+    logger.error("Internal server error", exc_info=(exctype, value, tb))
+    status = "500 Internal Server Error"
+    return (status,
+            [('Content-Type', 'text/html; charset=utf-8')],
+            ["<h1>{}</h1><p>{}</p>"
+             "".format(status, repr(exctype).strip('<>')).encode('utf-8')])
+
+
+def keylist_request(environ):
+    """Dataset and keys of a POST of a key list to an endpoint
+
+    :returns: tuple
+      (DatasetDescriptor, list of keys), or (None, error response) if the
+      request can't be served
+    """
+    uri_parts = environ.get(PATH_IN_ENV).split('/')
+    # 3 substracted levels: annex/objects/endpoint
+    ds_dir = Path(environ.get("CONTEXT_DOCUMENT_ROOT", '/')).joinpath(
+        *uri_parts[1:-3])
+    try:
+        dataset = get_dataset_descriptor(ds_dir)
+    except OSError:
+        return None, error_response("404 Not Found")
+    if dataset.layout_version not in ('1', '2'):
+        # see AnnexObject; fail before starting to respond
+        return None, error_response("500 Internal Server Error")
+    try:
+        return dataset, read_keylist(environ)
+    except ValueError:
+        return None, error_response("413 Payload Too Large")
+
+
+def presence_response(environ):
+    """Report presence, location and size for a list of keys in a dataset
+
+    Expects a POST of whitespace-separated keys to
+    <dataset>/annex/objects/.ria-presence and responds with a line
+    "<key>\t<location>\t<size>" per key. Location is 'tree', 'archive' or '-'
+    (not present), size is '-' if unknown.
+    """
+    dataset, keys = keylist_request(environ)
+    if dataset is None:
+        return keys
+
+    def report():
+        lines = []
+        for key, location, size in locate_keys(dataset, keys):
+            lines.append('{}\t{}\t{}\n'.format(
+                key,
+                location or '-',
+                '-' if size is None else size))
+            if len(lines) >= 1000:
+                yield ''.join(lines).encode('utf-8', 'surrogateescape')
+                lines = []
+        if lines:
+            yield ''.join(lines).encode('utf-8', 'surrogateescape')
+
+    return ("200 OK",
+            [('Content-Type', 'text/plain; charset=utf-8')],
+            report())
+
+
+def iter_tar_member(name, size, f):
+    """Stream a tar archive member
+
+    :param name: str
+    :param size: int
+    :param f: binary file-like
+      to read `size` bytes of content from. If it ends prematurely, the member
+      is padded with zeros.
+    :returns: generator of bytes, returning whether the content was complete
+    """
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mode = 0o444
+    # long names go into a pax header
+    yield info.tobuf(format=tarfile.PAX_FORMAT)
+    remaining = size
+    while remaining:
+        block = f.read(min(remaining, BLOCKSIZE))
+        if not block:
+            break
+        remaining -= len(block)
+        yield block
+    padding = remaining + (-size % tarfile.BLOCKSIZE)
+    while padding:
+        n = min(padding, BLOCKSIZE)
+        yield bytes(n)
+        padding -= n
+    return not remaining
+
+
+def bundle_response(environ):
+    """Stream the content of a list of keys in a dataset as a tar archive
+
+    Expects a POST of whitespace-separated keys to
+    <dataset>/annex/objects/.ria-bundle. Each key's content is a member named
+    by the key. Keys in the object tree come first, followed by the archived
+    ones, archive by archive (in order of their first requested key) in
+    archive order, with the members of a compressed archive extracted by a
+    single 7z process. The last member,
+    BUNDLE_TRAILER, has a line "<key>\t<reason>" per requested key, that
+    isn't (completely) in the bundle.
+    """
+    dataset, keys = keylist_request(environ)
+    if dataset is None:
+        return keys
+    client = environ.get('REMOTE_ADDR')
+    environ['ria.metrics'].source = 'bundle'
+
+    # (key, path, size)
+    tree = []
+    # archive path -> list of (key, member path, ArchiveMember)
+    archived = OrderedDict()
+    # archive path -> member path -> position
+    positions = dict()
+    # (key, reason)
+    missing = []
+    seen = set()
+    for key in keys:
+        if key in seen:
+            continue
+        seen.add(key)
+        if not key or key.startswith('.') or '/' in key:
+            # not a key, but possibly an attempt to escape the dataset
+            missing.append((key, 'invalid'))
+            continue
+        if presence_index is not None and \
+                presence_index.absent(dataset.ds_dir, key):
+            missing.append((key, 'not present'))
+            continue
+        key_object = AnnexObject.from_key(dataset, key)
+        if key_object.in_object_tree():
+            tree.append((key, key_object.file_path,
+                         key_object.tree_size()))
+        elif key_object.in_archive():
+            archive_path = key_object.archive_path
+            member_path = str(key_object.object_path)
+            if archive_path not in positions:
+                index = get_archive_index(archive_path)
+                positions[archive_path] = {
+                    m: i for i, m in enumerate(
+                        index.members if index is not None else ())}
+            archived.setdefault(archive_path, []).append(
+                (key, member_path, key_object.archive_member()))
+        else:
+            missing.append((key, 'not present'))
+
+    def stream():
+        for key, path, size in tree:
+            try:
+                f = path.open('rb')
+            except OSError:
+                missing.append((key, 'not readable'))
+                continue
+            with f:
+                complete = yield from iter_tar_member(key, size, f)
+            if not complete:
+                missing.append((key, 'truncated'))
+
+        for archive_path, members in archived.items():
+            members.sort(key=lambda m: positions[archive_path].get(m[1], -1))
+            # stored uncompressed: slices of the archive file
+            stored = [m for m in members
+                      if m[2] is not None and m[2].offset is not None]
+            if stored:
+                try:
+                    f = archive_path.open('rb')
+                except OSError:
+                    missing.extend((m[0], 'not readable') for m in stored)
+                else:
+                    with f:
+                        for key, _, member in stored:
+                            f.seek(member.offset)
+                            complete = yield from iter_tar_member(
+                                key, member.size, ObjectStream(f, 0,
+                                                               member.size))
+                            if not complete:
+                                missing.append((key, 'truncated'))
+            compressed = [m for m in members if m not in stored]
+            missing.extend((m[0], 'size unknown') for m in compressed
+                           if m[2] is None or m[2].size is None)
+            compressed = [m for m in compressed
+                          if m[2] is not None and m[2].size is not None]
+            if not compressed:
+                continue
+            with tempfile.NamedTemporaryFile(
+                    'w', encoding='utf-8', errors='surrogateescape',
+                    prefix='ria-bundle-', suffix='.lst') as listfile:
+                listfile.writelines(m[1] + '\n' for m in compressed)
+                listfile.flush()
+                extraction = BundleExtraction(archive_path, listfile.name,
+                                              client)
+                try:
+                    f = extraction.start()
+                except (ExtractionUnavailableError, OSError):
+                    missing.extend((m[0], 'extraction unavailable')
+                                   for m in compressed)
+                    continue
+                try:
+                    for key, _, member in compressed:
+                        complete = yield from iter_tar_member(
+                            key, member.size, f)
+                        if not complete:
+                            missing.append((key, 'truncated'))
+                finally:
+                    # ends the extraction, releases its slot
+                    f.close()
+
+        trailer = ''.join('{}\t{}\n'.format(*m) for m in missing).encode(
+            'utf-8', 'surrogateescape')
+        yield from iter_tar_member(BUNDLE_TRAILER, len(trailer),
+                                   BytesIO(trailer))
+        # end of archive
+        yield bytes(2 * tarfile.BLOCKSIZE)
+
+    return ("200 OK",
+            [('Content-Type', 'application/x-tar')],
+            stream())
+
+
+def is_not_modified(environ, key_object):
+    """Whether a conditional request can be answered with "304 Not Modified"
+
+    Since the content behind a key never changes, this doesn't require to look
+    at the content: Any copy a client has is still valid. However, a 304 also
+    tells the client, that the key is (still) available. Hence, it's only
+    answered if the key is present (checking that doesn't read the content).
+
+    :param environ: dict
+    :param key_object: AnnexObject
+    :returns: bool
+    """
+    if_none_match = environ.get('HTTP_IF_NONE_MATCH', '').strip()
+    if if_none_match:
+        tags = [t.strip() for t in if_none_match.split(',')]
+        if '*' in tags:
+            return key_object.is_present()
+        # weak comparison as required for If-None-Match
+        return key_object.etag() in [t[2:] if t.startswith('W/') else t
+                                     for t in tags] and \
+            key_object.is_present()
+    # If-Modified-Since is to be ignored in presence of If-None-Match
+    if_modified_since = environ.get('HTTP_IF_MODIFIED_SINCE', '').strip()
+    if if_modified_since:
+        try:
+            parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            # invalid date
+            return False
+        return key_object.is_present()
+    return False
+
+
+def caching_headers(key_object, last_modified=True):
+    """Response header fields allowing to cache the key's content
+
+    :param key_object: AnnexObject
+    :param last_modified: bool
+      whether to include Last-Modified
+    :returns: list of tuples
+    """
+    headers = [('ETag', key_object.etag()),
+               ('Cache-Control', CACHE_CONTROL)]
+    mtime = key_object.last_modified() if last_modified else None
+    if mtime is not None:
+        headers.append(('Last-Modified', formatdate(mtime, usegmt=True)))
+    return headers
+
+
+def respond(environ):
+    """Determine the response to a request
+
+    This is independent of the server interface, see `application()` for
+    WSGI.
+
+    :param environ: dict
+      WSGI-style environment of the request
+    :returns: tuple
+      (status, headers, body) with `body` being a list or an iterable of bytes,
+      a binary file-like to stream the content from, or an ArchiveExtraction
+      to be started for streaming.
+    """
 
     response_headers = list()
     response_body = None
+    request_metrics = environ.setdefault(
+        'ria.metrics',
+        RequestMetrics(environ.get('REQUEST_METHOD'), environ.get(PATH_IN_ENV)))
+
+    endpoint = (environ.get(PATH_IN_ENV) or '').rsplit('/', 1)[-1]
+    if endpoint == PRESENCE_ENDPOINT and not environ['QUERY_STRING'] and \
+            environ['REQUEST_METHOD'] == 'POST':
+        return presence_response(environ)
+    if endpoint == BUNDLE_ENDPOINT and not environ['QUERY_STRING'] and \
+            environ['REQUEST_METHOD'] == 'POST':
+        return bundle_response(environ)
+    if environ.get(PATH_IN_ENV) == '/' + METRICS_ENDPOINT and \
+            not environ['QUERY_STRING'] and environ['REQUEST_METHOD'] == 'GET':
+        response_body = metrics.render().encode('utf-8')
+        return ("200 OK",
+                [('Content-Type', 'text/plain; version=0.0.4; charset=utf-8'),
+                 ('Content-Length', str(len(response_body)))],
+                [response_body])
 
     # fail early on invalid requests:
     # TODO: This probably needs to be enhanced. For now just have some rejection
@@ -187,8 +2859,18 @@ def application(environ, start_response):
         response_headers.extend([('Content-Type', 'text/html; charset=utf-8'),
                                  ('Content-Length', str(len(response_body)))
                                  ])
-        start_response(status, response_headers)
-        return [response_body]
+        return status, response_headers, [response_body]
+
+    if presence_index is not None:
+        # answer requests for absent keys without touching the dataset
+        with request_metrics.phase('presence_index'):
+            uri_parts = (environ.get(PATH_IN_ENV) or '').split('/')
+            absent = len(uri_parts) > 7 and presence_index.absent(
+                Path(environ.get("CONTEXT_DOCUMENT_ROOT", '/')).joinpath(
+                    *uri_parts[1:-6]),
+                uri_parts[-1])
+        if absent:
+            return error_response("404 Not Found")
 
     # TODO: consider using the following rathern than querying env vars. Setup
     #       might be more complex.
@@ -200,35 +2882,88 @@ def application(environ, start_response):
     #       exception in AnnexObject.__init__ and therefore to an 500 response,
     #       which may or may not be wat we want.
     key_object = AnnexObject(environ.get(PATH_IN_ENV),
-                             environ.get("CONTEXT_DOCUMENT_ROOT", '/'))
+                             environ.get("CONTEXT_DOCUMENT_ROOT", '/'),
+                             request_metrics)
+
+    if is_not_modified(environ, key_object):
+        # Note, that this doesn't touch the key's content
+        status = "304 Not Modified"
+        response_headers.extend(caching_headers(key_object,
+                                                last_modified=False))
+        return status, response_headers, []
 
     if environ.get("REQUEST_METHOD") == "GET":
         try:
-            f = key_object.get()
-            if 'wsgi.file_wrapper' in environ:  # optional acc. to WSGI spec
-                response_body = environ['wsgi.file_wrapper'](f)
-            else:
-                response_body = iter(lambda: f.read(BLOCKSIZE), b'')
+            if not key_object.is_present():
+                raise KeyNotFoundError
 
-            status = "200 OK"
-            response_headers.extend([
-               ('Content-Type', 'application/octet-stream'),
-               ('Content-Disposition',
-                'attachment; filename=\"{}\"'.format(key_object.key))
-            ])
             try:
-                response_headers.append(('Content-Length',
-                                         str(key_object.size())))
+                size = key_object.size()
             except ValueError:
                 # invalid key
                 # TODO: for now just no size info
                 #       but:
                 #       we might want to consider checking this before hand and
                 #       reject to serve sth that is based on an invalid key
-                pass
+                size = None
+            if not key_object.in_object_tree():
+                member = key_object.archive_member()
+                if member is not None:
+                    if size is not None and size != member.size:
+                        # Don't serve anything else, be it more (e.g. the
+                        # following members of an uncompressed archive) or
+                        # less than announced.
+                        raise ArchiveFormatError(
+                            "{}: size of archive member {} doesn't match its "
+                            "key".format(key_object.archive_path,
+                                         key_object.object_path))
+                    # the archive tells, if the key doesn't
+                    size = member.size
+
+            # Note, that ranges can't be served w/o knowing the total size
+            byte_range = None
+            if size is not None and environ.get('HTTP_RANGE') and \
+                    if_range_matches(environ, key_object):
+                byte_range = parse_range(environ['HTTP_RANGE'], size)
+
+            if byte_range is None:
+                f = key_object.open()
+                status = "200 OK"
+            else:
+                first, last = byte_range
+                f = key_object.open(first, last - first + 1)
+                status = "206 Partial Content"
+            if isinstance(f, ArchiveExtraction):
+                f.client = environ.get('REMOTE_ADDR')
+            response_body = f
 
-            # TODO: ETag header field using the key itself?
+            response_headers.extend([
+               ('Content-Type', 'application/octet-stream'),
+               ('Content-Disposition',
+                'attachment; filename=\"{}\"'.format(key_object.key))
+            ])
+            if byte_range is not None:
+                response_headers.extend([
+                    ('Content-Range',
+                     'bytes {}-{}/{}'.format(first, last, size)),
+                    ('Content-Length', str(last - first + 1))
+                ])
+            elif size is not None:
+                response_headers.append(('Content-Length', str(size)))
+            elif getattr(f, 'length', None) is not None:
+                # key doesn't tell, but the archive did
+                response_headers.append(('Content-Length', str(f.length)))
+            if size is not None:
+                response_headers.append(('Accept-Ranges', 'bytes'))
+            response_headers.extend(caching_headers(key_object))
 
+        except RangeNotSatisfiableError:
+            status = "416 Range Not Satisfiable"
+            response_headers.extend([
+                ('Content-Type', 'text/html; charset=utf-8'),
+                ('Content-Range', 'bytes */{}'.format(size))
+            ])
+            response_body = ["<h1>{}</h1>".format(status).encode('utf-8')]
         except KeyNotFoundError:
             status = "404 Not Found"
             response_headers.append(('Content-Type', 'text/html; charset=utf-8'))
@@ -243,14 +2978,8 @@ def application(environ, start_response):
             response_body = ["<h1>{}</h1>".format(status).encode('utf-8')]
         except Exception as e:
             # something else failed
-            # Note: report error class only to not reveal anything internal
             # TODO: Figure out proper exception detection and error reporting
-            exctype, value, tb = sys.exc_info()
-            status = "500 Internal Server Error"
-            response_headers.append(('Content-Type', 'text/html; charset=utf-8'))
-            response_body = ["<h1>{}</h1><p>{}</p>"
-                             "".format(status, repr(exctype).strip('<>')
-                                       ).encode('utf-8')]
+            status, response_headers, response_body = server_error_response()
 
     elif environ.get("REQUEST_METHOD") == "HEAD":
         # Check key availability and respond accordingly
@@ -261,15 +2990,18 @@ def application(environ, start_response):
             status = "200 OK"
             response_headers.append(('Content-Type', 'application/octet-stream'))
             try:
-                response_headers.append(('Content-Length',
-                                         str(key_object.size())))
+                size = key_object.size()
             except ValueError:
                 # invalid key
                 # TODO: for now just no size info
                 #       but:
                 #       we might want to consider checking this before hand and
                 #       reject to serve sth that is based on an invalid key
-                pass
+                size = None
+            if size is not None:
+                response_headers.extend([('Content-Length', str(size)),
+                                         ('Accept-Ranges', 'bytes')])
+            response_headers.extend(caching_headers(key_object))
 
         else:
             status = "404 Not Found"
@@ -279,5 +3011,40 @@ def application(environ, start_response):
                  ('Content-Length', str(len(response_body)))
                  ])
 
+    return status, response_headers, response_body or []
+
+
+def application(environ, start_response):
+
+    request_metrics = environ['ria.metrics'] = \
+        RequestMetrics(environ.get('REQUEST_METHOD'), environ.get(PATH_IN_ENV))
+    start_metrics_writer()
+    status, response_headers, response_body = respond(environ)
+
+    if isinstance(response_body, ArchiveExtraction):
+        try:
+            with request_metrics.phase('extraction_start'):
+                response_body = response_body.start()
+        except ExtractionUnavailableError:
+            status, response_headers, response_body = error_response(
+                "503 Service Unavailable",
+                [('Retry-After', str(RETRY_AFTER))])
+        except OSError:
+            # e.g. missing 7z executable
+            status, response_headers, response_body = server_error_response()
+    request_metrics.status = status
+
+    if hasattr(response_body, 'read'):
+        content_length = dict(response_headers).get('Content-Length')
+        length = int(content_length) if content_length else None
+        f = MeteredFile(response_body, request_metrics, length)
+        if 'wsgi.file_wrapper' in environ:  # optional acc. to WSGI spec
+            response_body = environ['wsgi.file_wrapper'](
+                f, stream_blocksize(length))
+        else:
+            response_body = iter_file(f, stream_blocksize(length))
+    else:
+        response_body = iter_metered(response_body, request_metrics)
+
     start_response(status, response_headers)
-    return response_body if response_body else []
+    return response_body
@@ -2,9 +2,17 @@
 
 import multiprocessing
 import os
+import socket
+import subprocess
+import sys
+import pytest
 import requests
 import tempfile
+import threading
+import time
 import hashlib
+import io
+import tarfile
 from pathlib import Path
 from wsgiref.simple_server import make_server
 from wsgiref.validate import validator
@@ -12,7 +20,21 @@ from unittest.mock import patch
 from datalad.api import Dataset
 from datalad.utils import rmtree
 
-from ria_wsgi import application
+import ria_wsgi
+from ria_wsgi import (
+    AnnexObject,
+    BloomFilter,
+    ObjectStream,
+    ExtractionCache,
+    ExtractionSlots,
+    PresenceIndex,
+    application,
+    get_archive_index,
+    get_dataset_descriptor,
+    respond,
+    stream_blocksize,
+)
+from ria_asgi import zerocopy_region
 
 
 # wrap our wsgi app in wsgiref's validator app to potentially raise
@@ -31,8 +53,25 @@ def _multiproc_serve(hostname, port, path, app, queue):
     httpd.serve_forever()
 
 
+def _multiproc_serve_asgi(hostname, port, path, app, queue):
+    import uvicorn
+    from ria_asgi import make_application
+
+    os.chdir(path)
+    sock = socket.socket()
+    sock.bind((hostname, port))
+    # accept connections (in backlog) right away
+    sock.listen(128)
+    queue.put(sock.getsockname()[1])
+    server = uvicorn.Server(uvicorn.Config(make_application(path),
+                                           log_level='warning'))
+    server.run(sockets=[sock])
+
+
 class WSGITestServer(object):
 
+    _serve = staticmethod(_multiproc_serve)
+
     def __init__(self, app, base_path):
         self.app = app
         self.base_path = base_path
@@ -49,10 +88,11 @@ class WSGITestServer(object):
 
     def start(self):
         hostname = '127.0.0.1'
-        port = 8080
+        # any free port
+        port = 0
         queue = multiprocessing.Queue()
         self._mproc = multiprocessing.Process(
-            target=_multiproc_serve,
+            target=self._serve,
             args=(hostname, port, self.base_path, self.app, queue))
         self._mproc.start()
         port = queue.get(timeout=300)
@@ -72,9 +112,59 @@ class WSGITestServer(object):
         self._mproc.terminate()
 
 
-def test_wsgi_no_store():
+class ASGITestServer(WSGITestServer):
+    """Serve ria_asgi via uvicorn"""
+
+    _serve = staticmethod(_multiproc_serve_asgi)
+
+    def __init__(self, base_path):
+        super(ASGITestServer, self).__init__(None, base_path)
+
+
+@pytest.fixture(params=['wsgi', 'asgi'])
+def serve(request):
+    """Test server factory; the same scenarios are run against the WSGI and
+    the ASGI application
+    """
+    if request.param == 'asgi':
+        pytest.importorskip('uvicorn')
+        return ASGITestServer
+    return lambda base_path: WSGITestServer(served_app, base_path)
+
+
+def _make_store(store_dir, contents):
+    """Set up a store with a single dataset (layout version 1)
+
+    Note, that object paths in request URLs are dirhashmixed, which is ignored
+    by layout version 1. Therefore the URLs don't need to be actual
+    dirhashmixed paths.
+
+    :param store_dir: Path
+    :param contents: list of bytes
+    :returns: tuple
+      (dataset path in store, dict mapping keys to (content, URL path))
+    """
+    (store_dir / 'ria-layout-version').write_text('1')
+    ds_in_store = store_dir / 'abc' / 'def'
+    ds_in_store.mkdir(parents=True)
+    (ds_in_store / 'ria-layout-version').write_text('1')
+
+    keys = dict()
+    for content in contents:
+        key = 'MD5E-s{}--{}.dat'.format(len(content),
+                                        hashlib.md5(content).hexdigest())
+        md5 = hashlib.md5(key.encode()).hexdigest()
+        key_dir = ds_in_store / 'annex' / 'objects' / md5[:3] / md5[3:] / key
+        key_dir.mkdir(parents=True)
+        (key_dir / key).write_bytes(content)
+        keys[key] = (content,
+                     'abc/def/annex/objects/xx/yy/{}/{}'.format(key, key))
+    return ds_in_store, keys
+
 
-    with WSGITestServer(served_app, '/') as store_url:
+def test_wsgi_no_store(serve):
+
+    with serve('/') as store_url:
         # there's no valid RIA store yet
         assert requests.get(store_url +
                             'some/non/existent/content').status_code == 500
@@ -89,7 +179,7 @@ def test_wsgi_no_store():
         assert requests.get(store_url + "?id=3").status_code == 400
 
 
-def test_wsgi_minimal_store():
+def test_wsgi_minimal_store(serve):
 
     # set up a minimal store;
     # doesn't require an actual repo;
@@ -99,7 +189,7 @@ def test_wsgi_minimal_store():
         (td / '123' / 'fakeid').mkdir(parents=True, exist_ok=True)
         (td / '123' / 'fakeid' / 'ria-layout-version').write_text('2')
 
-        with WSGITestServer(served_app, str(td)) as store_url:
+        with serve(str(td)) as store_url:
             # setup should suffice to get a 404 instead of a 500:
             assert requests.get(
                 store_url + 'some/non/existent').status_code == 404
@@ -111,7 +201,7 @@ def test_wsgi_minimal_store():
             assert requests.get(store_url + "?id=3").status_code == 400
 
 
-def test_wsgi_actual_store():
+def test_wsgi_actual_store(serve):
 
     with tempfile.TemporaryDirectory() as dsdir, \
             tempfile.TemporaryDirectory() as storedir:
@@ -143,7 +233,7 @@ def test_wsgi_actual_store():
         (dsdir / '.git' / 'annex' / 'objects').rename(
             ds_in_store / 'annex' / 'objects')
 
-        with WSGITestServer(served_app, str(storedir)) as store_url:
+        with serve(str(storedir)) as store_url:
             base_url = store_url + ds.id[:3] + '/' + ds.id[3:] \
                        + '/annex' + '/objects/'
 
@@ -188,3 +278,720 @@ def test_wsgi_actual_store():
                 assert response.status_code == 200
                 md5 = hashlib.md5(response.content).hexdigest()
                 assert md5 == str(key_path).split('--')[-1]
+
+
+def test_archive_index():
+
+    with tempfile.TemporaryDirectory() as td:
+        td = Path(td)
+        obj_dir = td / 'objects'
+        (obj_dir / 'ab').mkdir(parents=True)
+        (obj_dir / 'ab' / 'one').write_text('1')
+        archive = td / 'archive.7z'
+
+        assert get_archive_index(archive) is None
+
+        subprocess.run(['7z', 'u', str(archive), '.', '-mx0'],
+                       cwd=str(obj_dir), check=True)
+        index = get_archive_index(archive)
+        assert 'ab/one' in index
+        assert 'ab' not in index
+        assert index.get('ab/one').size == 1
+        # uncompressed: data can be read from the archive directly
+        offset = index.get('ab/one').offset
+        with archive.open('rb') as f:
+            f.seek(offset)
+            assert f.read(1) == b'1'
+        # listing is read once
+        assert get_archive_index(archive) is index
+
+        # updating the archive invalidates the index
+        (obj_dir / 'cd').mkdir()
+        (obj_dir / 'cd' / 'two').write_text('22')
+        subprocess.run(['7z', 'u', str(archive), '.', '-mx0'],
+                       cwd=str(obj_dir), check=True)
+        updated = get_archive_index(archive)
+        assert updated is not index
+        assert 'ab/one' in updated
+        assert updated.get('cd/two').size == 2
+
+        archive.unlink()
+        assert get_archive_index(archive) is None
+
+
+def test_wsgi_archive_size_mismatch(serve):
+
+    with tempfile.TemporaryDirectory() as store_dir:
+        store_dir = Path(store_dir)
+        ds_in_store, keys = _make_store(store_dir, [b'short', b'SECRETDATA'])
+        # a key claiming more content than its archive member has
+        short_key = [k for k in keys if k.startswith('MD5E-s5-')][0]
+        wrong_key = short_key.replace('-s5-', '-s20-')
+        objects_dir = ds_in_store / 'annex' / 'objects'
+        md5 = hashlib.md5(short_key.encode()).hexdigest()
+        wrong_md5 = hashlib.md5(wrong_key.encode()).hexdigest()
+        (objects_dir / wrong_md5[:3] / wrong_md5[3:] / wrong_key).mkdir(
+            parents=True)
+        (objects_dir / md5[:3] / md5[3:] / short_key / short_key).rename(
+            objects_dir / wrong_md5[:3] / wrong_md5[3:] / wrong_key /
+            wrong_key)
+        (ds_in_store / 'archives').mkdir()
+        subprocess.run(['7z', 'a', '-mx0',
+                        str(ds_in_store / 'archives' / 'archive.7z'), '.'],
+                       cwd=str(objects_dir), check=True)
+        rmtree(str(objects_dir))
+
+        with serve(str(store_dir)) as store_url:
+            url = '{}abc/def/annex/objects/xx/yy/{}/{}'.format(
+                store_url, wrong_key, wrong_key)
+            # neither more (the next member), nor less than announced
+            assert requests.get(url).status_code == 500
+            assert requests.get(
+                url, headers={'Range': 'bytes=0-10'}).status_code == 500
+
+
+def test_wsgi_range(serve):
+
+    content = bytes(range(256)) * 4
+    with tempfile.TemporaryDirectory() as store_dir:
+        store_dir = Path(store_dir)
+        ds_in_store, keys = _make_store(store_dir, [content])
+        key, (content, path) = keys.popitem()
+
+        with serve(str(store_dir)) as store_url:
+            url = store_url + path
+
+            def check_ranges():
+                response = requests.head(url)
+                assert response.headers['Accept-Ranges'] == 'bytes'
+
+                response = requests.get(url, headers={'Range': 'bytes=2-5'})
+                assert response.status_code == 206
+                assert response.content == content[2:6]
+                assert response.headers['Content-Range'] == \
+                    'bytes 2-5/1024'
+                assert response.headers['Content-Length'] == '4'
+
+                # open-ended and suffix ranges
+                response = requests.get(url, headers={'Range': 'bytes=1000-'})
+                assert response.status_code == 206
+                assert response.content == content[1000:]
+                response = requests.get(url, headers={'Range': 'bytes=-10'})
+                assert response.status_code == 206
+                assert response.content == content[-10:]
+                # end beyond content is truncated
+                response = requests.get(url,
+                                        headers={'Range': 'bytes=1020-5000'})
+                assert response.status_code == 206
+                assert response.content == content[1020:]
+                assert response.headers['Content-Range'] == \
+                    'bytes 1020-1023/1024'
+
+                # nothing to serve
+                response = requests.get(url, headers={'Range': 'bytes=1024-'})
+                assert response.status_code == 416
+                assert response.headers['Content-Range'] == 'bytes */1024'
+
+                # invalid or multiple ranges are ignored
+                for r in ['bytes=5-2', 'lines=1-2', 'bytes=1-2,5-6']:
+                    response = requests.get(url, headers={'Range': r})
+                    assert response.status_code == 200
+                    assert response.content == content
+
+                # If-Range
+                response = requests.get(url, headers={
+                    'Range': 'bytes=2-5', 'If-Range': '"{}"'.format(key)})
+                assert response.status_code == 206
+                assert response.content == content[2:6]
+                response = requests.get(url, headers={
+                    'Range': 'bytes=2-5', 'If-Range': '"other"'})
+                assert response.status_code == 200
+                assert response.content == content
+
+            check_ranges()
+
+            # absent key
+            response = requests.get(store_url + path.replace('s1024', 's1025'),
+                                    headers={'Range': 'bytes=2-5'})
+            assert response.status_code == 404
+
+            # same from an uncompressed and a compressed archive
+            (ds_in_store / 'archives').mkdir()
+            for level in ['0', '5']:
+                subprocess.run(['7z', 'a',
+                                str(ds_in_store / 'archives' /
+                                    'mx{}.7z'.format(level)),
+                                '.', '-mx' + level],
+                               cwd=str(ds_in_store / 'annex' / 'objects'),
+                               check=True)
+            rmtree(str(ds_in_store / 'annex'))
+            for level in ['0', '5']:
+                (ds_in_store / 'archives' / 'mx{}.7z'.format(level)).rename(
+                    ds_in_store / 'archives' / 'archive.7z')
+                check_ranges()
+
+
+def test_stream_blocksize():
+
+    with patch.object(ria_wsgi, 'BLOCKSIZE', 1024):
+        # unknown length
+        assert stream_blocksize() == 1024
+        # small content is read at once
+        assert stream_blocksize(100) == 100
+        assert stream_blocksize(0) == 1
+        assert stream_blocksize(10 ** 6) == 1024
+    # configured via the environment
+    assert subprocess.run(
+        [sys.executable, '-c', 'import ria_wsgi; print(ria_wsgi.BLOCKSIZE)'],
+        env=dict(os.environ, RIA_BLOCKSIZE='8192'),
+        cwd=str(Path(__file__).parent), stdout=subprocess.PIPE,
+        universal_newlines=True, check=True).stdout.strip() == '8192'
+
+
+def test_zerocopy_region():
+
+    with tempfile.TemporaryDirectory() as td:
+        path = Path(td) / 'archive'
+        path.write_bytes(bytes(100))
+        with path.open('rb') as f:
+            assert zerocopy_region(f, None) == (0, 100)
+            f.seek(10)
+            assert zerocopy_region(f, None) == (10, 90)
+            assert zerocopy_region(f, 5) == (10, 5)
+        # a slice never extends beyond its end, nor the file's
+        for offset, length, length_header, expected in (
+                (10, 20, None, (10, 20)),
+                (10, 20, 50, (10, 20)),
+                (10, 20, 5, (10, 5)),
+                (90, 20, None, (90, 10))):
+            f = ObjectStream(path.open('rb'), offset, length)
+            try:
+                assert zerocopy_region(f, length_header) == expected
+            finally:
+                f.close()
+        # not a regular file
+        r, w = os.pipe()
+        with os.fdopen(r, 'rb') as f, os.fdopen(w, 'wb'):
+            assert zerocopy_region(f, None) is None
+        assert zerocopy_region(io.BytesIO(b'content'), None) is None
+
+
+def test_dataset_descriptor():
+
+    with tempfile.TemporaryDirectory() as ds_dir:
+        ds_dir = Path(ds_dir)
+        (ds_dir / 'ria-layout-version').write_text('2|some-future-flag\n')
+        # pretend that the dataset wasn't modified recently
+        os.utime(str(ds_dir), (0, 0))
+
+        descriptor = get_dataset_descriptor(ds_dir)
+        assert descriptor.layout_version == '2'
+        assert descriptor.objects_dir == ds_dir / 'annex' / 'objects'
+        assert not descriptor.has_archives
+        # cached
+        assert get_dataset_descriptor(ds_dir) is descriptor
+
+        # new archives directory changes the dataset directory's mtime
+        (ds_dir / 'archives').mkdir()
+        updated = get_dataset_descriptor(ds_dir)
+        assert updated is not descriptor
+        assert updated.has_archives
+
+
+def test_wsgi_conditional(serve):
+
+    with tempfile.TemporaryDirectory() as store_dir:
+        store_dir = Path(store_dir)
+        ds_in_store, keys = _make_store(store_dir, [b'content'])
+        key, (content, path) = keys.popitem()
+
+        with serve(str(store_dir)) as store_url:
+            url = store_url + path
+            etag = '"{}"'.format(key)
+
+            for response in (requests.head(url), requests.get(url)):
+                assert response.status_code == 200
+                assert response.headers['ETag'] == etag
+                assert 'immutable' in response.headers['Cache-Control']
+                assert 'Last-Modified' in response.headers
+            last_modified = response.headers['Last-Modified']
+
+            # other content
+            response = requests.get(url, headers={'If-None-Match': '"other"'})
+            assert response.status_code == 200
+            assert response.content == content
+
+            conditions = ({'If-None-Match': etag},
+                          {'If-None-Match': '"other", W/' + etag},
+                          {'If-None-Match': '*'},
+                          {'If-Modified-Since': last_modified})
+            for headers in conditions:
+                for response in (requests.head(url, headers=headers),
+                                 requests.get(url, headers=headers)):
+                    assert response.status_code == 304
+                    assert response.headers['ETag'] == etag
+                    assert not response.content
+
+            # a client's copy is still valid, but the key isn't available
+            # anymore
+            rmtree(str(ds_in_store / 'annex'))
+            for headers in conditions:
+                for response in (requests.head(url, headers=headers),
+                                 requests.get(url, headers=headers)):
+                    assert response.status_code == 404
+
+
+def test_wsgi_presence(serve):
+
+    with tempfile.TemporaryDirectory() as store_dir:
+        store_dir = Path(store_dir)
+        ds_in_store, keys = _make_store(store_dir, [b'tree', b'archived'])
+        archived_key = [k for k in keys if k.startswith('MD5E-s8-')][0]
+        tree_key = [k for k in keys if k.startswith('MD5E-s4-')][0]
+        absent_key = 'MD5E-s1--' + 32 * '0'
+
+        # move a key into an archive
+        (ds_in_store / 'archives').mkdir()
+        md5 = hashlib.md5(archived_key.encode()).hexdigest()
+        archived_path = str(Path(md5[:3], md5[3:], archived_key, archived_key))
+        subprocess.run(['7z', 'a',
+                        str(ds_in_store / 'archives' / 'archive.7z'),
+                        archived_path],
+                       cwd=str(ds_in_store / 'annex' / 'objects'),
+                       check=True)
+        (ds_in_store / 'annex' / 'objects' / archived_path).unlink()
+
+        with serve(str(store_dir)) as store_url:
+            url = store_url + 'abc/def/annex/objects/.ria-presence'
+            expected = {
+                tree_key: ['tree', '4'],
+                archived_key: ['archive', '8'],
+                absent_key: ['-', '-'],
+                '../../../ria-layout-version': ['-', '-'],
+            }
+            # individual lookups and shared listing of the object tree
+            for n_absent in (0, 1000):
+                more = ['MD5E-s1--{:032d}'.format(i) for i in range(n_absent)]
+                response = requests.post(url,
+                                         data='\n'.join(list(expected) + more))
+                assert response.status_code == 200
+                reported = [line.split('\t')
+                            for line in response.text.splitlines()]
+                assert len(reported) == len(expected) + n_absent
+                for line in reported[:len(expected)]:
+                    assert expected[line[0]] == line[1:]
+                assert all(line[1] == '-' for line in reported[len(expected):])
+
+            # only POST
+            assert requests.get(url).status_code == 404
+            # a key list too large is rejected before it's sent
+            host, port = store_url.split('/')[2].split(':')
+            with socket.create_connection((host, int(port))) as sock:
+                sock.sendall(
+                    'POST /abc/def/annex/objects/.ria-presence HTTP/1.1\r\n'
+                    'Host: {}\r\nContent-Length: {}\r\n\r\n'.format(
+                        host, ria_wsgi.MAX_KEYLIST_SIZE + 1).encode())
+                assert sock.recv(1024).split()[1] == b'413'
+            # unknown dataset
+            assert requests.post(
+                store_url + 'abc/xyz/annex/objects/.ria-presence',
+                data=absent_key).status_code == 404
+
+
+def test_extraction_slots():
+
+    slots = ExtractionSlots(limit=2, client_limit=1, queue_size=1)
+    assert slots.acquire('a', 0)
+    # client 'a' uses all its slots
+    assert not slots.acquire('a', 0)
+    assert slots.acquire('b', 0)
+    # all slots in use
+    assert not slots.acquire('c', 0)
+    slots.release('a')
+    assert slots.acquire('c', 0)
+
+    # waiting requests are served in order
+    order = []
+
+    def wait(client):
+        if slots.acquire(client, 10):
+            order.append(client)
+
+    waiting = threading.Thread(target=wait, args=('d',))
+    waiting.start()
+    while not slots._waiting:
+        time.sleep(0.01)
+    # queue is full
+    assert not slots.acquire('e', 10)
+    slots.release('b')
+    waiting.join()
+    assert order == ['d']
+    assert slots.active == 2
+
+    # waiting requests of a client using all its slots don't hold up others
+    slots = ExtractionSlots(limit=4, client_limit=1, queue_size=2)
+    assert slots.acquire('a', 0)
+    waiting = [threading.Thread(target=wait, args=('a',)) for _ in range(2)]
+    for t in waiting:
+        t.start()
+    while len(slots._waiting) < 2:
+        time.sleep(0.01)
+    # but their number is limited
+    assert not slots.acquire('a', 0)
+    assert slots.acquire('b', 0)
+    assert slots.active == 2
+    slots.release('b')
+    slots.release('a')
+    while len(slots._waiting) > 1:
+        time.sleep(0.01)
+    slots.release('a')
+    for t in waiting:
+        t.join()
+    assert order == ['d', 'a', 'a']
+
+
+def test_extraction_cache():
+
+    with tempfile.TemporaryDirectory() as store_dir, \
+            tempfile.TemporaryDirectory() as cache_dir:
+        store_dir = Path(store_dir)
+        contents = [os.urandom(100000), os.urandom(100001)]
+        ds_in_store, keys = _make_store(store_dir, contents)
+        (ds_in_store / 'archives').mkdir()
+        objects_dir = ds_in_store / 'annex' / 'objects'
+        subprocess.run(['7z', 'a', '-mx5',
+                        str(ds_in_store / 'archives' / 'archive.7z'), '.'],
+                       cwd=str(objects_dir), check=True)
+        rmtree(str(objects_dir))
+        objects_dir.mkdir()
+        dataset = get_dataset_descriptor(ds_in_store)
+        first, second = sorted(keys, key=lambda k: len(keys[k][0]))
+
+        # room for one of them only
+        cache = ExtractionCache(Path(cache_dir) / 'cache', 150000)
+        with patch.object(ria_wsgi, 'extraction_cache', cache):
+            key_object = AnnexObject.from_key(dataset, first)
+            # not cached yet
+            assert key_object.open(5, 10).cached is False
+            leader = key_object.get()
+            assert leader.read(50000) == keys[first][0][:50000]
+            # concurrent requests follow the extraction in progress
+            follower = AnnexObject.from_key(dataset, first).get(5, 10)
+            # the leader being gone doesn't stop it
+            leader.close()
+            assert follower.read() == keys[first][0][5:15]
+            follower.close()
+            while len(cache._fills):
+                time.sleep(0.01)
+            assert cache.total == len(keys[first][0])
+
+            # served from the cache
+            f = AnnexObject.from_key(dataset, first).open()
+            assert isinstance(f, io.BufferedReader)
+            assert f.read() == keys[first][0]
+            f.close()
+
+            # caching another one evicts the first
+            f = AnnexObject.from_key(dataset, second).get()
+            assert f.read() == keys[second][0]
+            f.close()
+            second_path = AnnexObject.from_key(dataset, second).object_path
+            assert [p.name for p in Path(cache_dir, 'cache').iterdir()] == \
+                [ExtractionCache.entry_name(dataset.archive_path,
+                                            str(second_path))]
+            assert cache.total == len(keys[second][0])
+
+        # incomplete entries of processes that are gone, or abandoned for
+        # long, are removed
+        cache_dir = Path(cache_dir) / 'other'
+        cache_dir.mkdir()
+        gone = subprocess.Popen(['true'])
+        gone.wait()
+        leftovers = ['.fill-{}-a'.format(gone.pid),
+                     '.fill-{}-b'.format(os.getpid()),
+                     '.fill-{}-c'.format(os.getpid())]
+        for name in leftovers:
+            (cache_dir / name).write_bytes(b'incomplete')
+        old = time.time() - ria_wsgi.STALE_FILL_AGE - 1
+        os.utime(str(cache_dir / leftovers[1]), (old, old))
+        cache = ExtractionCache(cache_dir, 150000)
+        assert cache.open(dataset.archive_path, str(second_path)) is None
+        assert [p.name for p in cache_dir.iterdir()] == [leftovers[2]]
+
+
+def test_wsgi_metrics(serve):
+
+    with tempfile.TemporaryDirectory() as store_dir:
+        store_dir = Path(store_dir)
+        _, keys = _make_store(store_dir, [b'content'])
+        content, path = list(keys.values())[0]
+
+        with serve(str(store_dir)) as store_url:
+            assert requests.get(store_url + path).content == content
+            assert requests.get(store_url + path,
+                                headers={'Range': 'bytes=1-2'}).content == \
+                content[1:3]
+            assert requests.head(store_url + path).status_code == 200
+            assert requests.get(
+                store_url + path.replace('MD5E', 'MD5')).status_code == 404
+
+            response = requests.get(store_url + '.ria-metrics')
+            assert response.status_code == 200
+            assert response.headers['Content-Type'].startswith('text/plain')
+            samples = dict(line.rsplit(' ', 1)
+                           for line in response.text.splitlines()
+                           if not line.startswith('#'))
+            labels = 'method="GET",status="{}",source="{}"'
+            assert samples['ria_requests_total{%s}'
+                           % labels.format(200, 'tree')] == '1'
+            assert samples['ria_response_bytes_total{%s}'
+                           % labels.format(206, 'tree')] == '2'
+            assert samples['ria_requests_total{%s}'
+                           % labels.format(404, '-')] == '1'
+            assert samples['ria_requests_total{%s}'
+                           % 'method="HEAD",status="200",source="-"'] == '1'
+            assert samples['ria_time_to_first_byte_seconds_count{%s}'
+                           % labels.format(200, 'tree')] == '1'
+            assert int(samples[
+                'ria_request_phase_seconds_bucket{phase="tree_stat",le="+Inf"}'
+            ]) >= 3
+
+
+def test_wsgi_archive_shards(serve):
+
+    with tempfile.TemporaryDirectory() as store_dir:
+        store_dir = Path(store_dir)
+        ds_in_store, keys = _make_store(store_dir,
+                                        [b'base', b'shard1', b'shard22'])
+        objects_dir = ds_in_store / 'annex' / 'objects'
+        archives_dir = ds_in_store / 'archives'
+        archives_dir.mkdir()
+        object_paths = {}
+        for key in keys:
+            md5 = hashlib.md5(key.encode()).hexdigest()
+            object_paths[len(keys[key][0])] = str(
+                Path(md5[:3], md5[3:], key, key))
+        manifest = []
+        for archive, size in (('archive.7z', 4),
+                              ('archive-0001.7z', 6),
+                              ('archive-0002.7z', 7)):
+            subprocess.run(['7z', 'a', str(archives_dir / archive),
+                            object_paths[size]],
+                           cwd=str(objects_dir), check=True)
+            (objects_dir / object_paths[size]).unlink()
+            if archive != 'archive.7z':
+                manifest.extend(['[{}]'.format(archive), object_paths[size]])
+        (archives_dir / 'manifest').write_text('\n'.join(manifest) + '\n')
+
+        with serve(str(store_dir)) as store_url:
+            for content, path in keys.values():
+                response = requests.get(store_url + path)
+                assert response.status_code == 200
+                assert response.content == content
+            response = requests.post(
+                store_url + 'abc/def/annex/objects/.ria-presence',
+                data='\n'.join(keys))
+            assert [line.split('\t')[1]
+                    for line in response.text.splitlines()] == 3 * ['archive']
+            # a key listed for a shard isn't looked up elsewhere
+            (archives_dir / 'manifest').write_text(
+                '[archive-0001.7z]\n{}\n'.format(object_paths[7]))
+            time.sleep(0.01)
+            _, path = [v for v in keys.values() if len(v[0]) == 7][0]
+            assert requests.get(store_url + path).status_code == 404
+
+
+def test_presence_index():
+
+    bloom = BloomFilter.from_items(str(i) for i in range(1000))
+    assert all(str(i) in bloom for i in range(1000))
+    # roughly the configured false positive rate
+    assert sum(str(i) in bloom for i in range(1000, 11000)) < 300
+
+    with tempfile.TemporaryDirectory() as store_dir:
+        store_dir = Path(store_dir)
+        ds_in_store, keys = _make_store(store_dir, [b'tree', b'archived'])
+        archived = [k for k in keys if keys[k][0] == b'archived'][0]
+        md5 = hashlib.md5(archived.encode()).hexdigest()
+        (ds_in_store / 'archives').mkdir()
+        subprocess.run(['7z', 'a',
+                        str(ds_in_store / 'archives' / 'archive.7z'),
+                        str(Path(md5[:3], md5[3:], archived, archived))],
+                       cwd=str(ds_in_store / 'annex' / 'objects'), check=True)
+        rmtree(str(ds_in_store / 'annex' / 'objects' / md5[:3]))
+
+        def backdate():
+            # modifications not within the mtime granularity of a scan
+            past = time.time() - 10
+            for d, _, _ in os.walk(str(ds_in_store)):
+                os.utime(d, (past, past))
+
+        backdate()
+        index = PresenceIndex(store_dir)
+        # not started; unknown datasets aren't reported absent
+        index._scanner = os.getpid()
+        assert not index.absent(ds_in_store, 'MD5E-s1--nothere')
+        index.scan()
+        assert set(index.datasets) == {str(ds_in_store)}
+        for key in keys:
+            assert not index.absent(ds_in_store, key)
+        missing = 'MD5E-s7--{}.dat'.format(hashlib.md5(b'missing').hexdigest())
+        assert index.absent(ds_in_store, missing)
+        assert not index.absent(store_dir / 'abc' / 'xyz', missing)
+
+        # requests for absent keys are answered from the index
+        environ = {'REQUEST_METHOD': 'HEAD', 'QUERY_STRING': '',
+                   'CONTEXT_DOCUMENT_ROOT': str(store_dir),
+                   'PATH_INFO': '/abc/def/annex/objects/xx/yy/{}/{}'.format(
+                       missing, missing)}
+        with patch('ria_wsgi.presence_index', index), \
+                patch('ria_wsgi.AnnexObject', side_effect=AssertionError):
+            assert respond(dict(environ))[0] == "404 Not Found"
+
+        # a key added since the scan isn't reported absent
+        new_md5 = hashlib.md5(missing.encode()).hexdigest()
+        key_dir = ds_in_store / 'annex' / 'objects' / new_md5[:3] / \
+            new_md5[3:] / missing
+        key_dir.mkdir(parents=True)
+        (key_dir / missing).write_bytes(b'missing')
+        assert not index.absent(ds_in_store, missing)
+        with patch('ria_wsgi.presence_index', index):
+            assert respond(dict(environ))[0] == "200 OK"
+        # and found by the next scan
+        backdate()
+        index.scan()
+        assert not index.absent(ds_in_store, missing)
+
+        # nor is one added to an archive
+        archived_too = 'MD5E-s4--{}.dat'.format(hashlib.md5(b'more').hexdigest())
+        assert index.absent(ds_in_store, archived_too)
+        more_md5 = hashlib.md5(archived_too.encode()).hexdigest()
+        more_path = Path(more_md5[:3], more_md5[3:], archived_too, archived_too)
+        with tempfile.TemporaryDirectory() as td:
+            (Path(td) / more_path).parent.mkdir(parents=True)
+            (Path(td) / more_path).write_bytes(b'more')
+            subprocess.run(['7z', 'a',
+                            str(ds_in_store / 'archives' / 'archive.7z'),
+                            str(more_path)],
+                           cwd=td, check=True)
+        assert not index.absent(ds_in_store, archived_too)
+
+
+def test_wsgi_bundle(serve):
+
+    with tempfile.TemporaryDirectory() as store_dir:
+        store_dir = Path(store_dir)
+        contents = [b'tree', b'stored1', b'stored22', b'compressed' * 100,
+                    b'compressed2' * 100]
+        ds_in_store, keys = _make_store(store_dir, contents)
+        objects_dir = ds_in_store / 'annex' / 'objects'
+        archives_dir = ds_in_store / 'archives'
+        archives_dir.mkdir()
+        object_paths = dict()
+        for key, (content, _) in keys.items():
+            md5 = hashlib.md5(key.encode()).hexdigest()
+            object_paths[content] = str(Path(md5[:3], md5[3:], key, key))
+        # uncompressed archive.7z and a compressed shard
+        for archive, members, options in (
+                ('archive.7z', contents[1:3], ['-mx0']),
+                ('archive-0001.7z', contents[3:], ['-mx5'])):
+            subprocess.run(['7z', 'a'] + options +
+                           [str(archives_dir / archive)] +
+                           [object_paths[c] for c in members],
+                           cwd=str(objects_dir), check=True)
+            for c in members:
+                (objects_dir / object_paths[c]).unlink()
+        (archives_dir / 'manifest').write_text(
+            '[archive-0001.7z]\n' +
+            ''.join(object_paths[c] + '\n' for c in contents[3:]))
+
+        by_content = {c: k for k, (c, _) in keys.items()}
+        missing = 'MD5E-s1--{}'.format(hashlib.md5(b'x').hexdigest())
+        requested = [by_content[c] for c in reversed(contents)] + \
+            [missing, '../escape', by_content[b'tree']]
+        with serve(str(store_dir)) as store_url:
+            response = requests.post(
+                store_url + 'abc/def/annex/objects/.ria-bundle',
+                data='\n'.join(requested))
+            assert response.status_code == 200
+            assert response.headers['Content-Type'] == 'application/x-tar'
+            with tarfile.open(fileobj=io.BytesIO(response.content)) as tar:
+                members = tar.getmembers()
+                names = [m.name for m in members]
+                # tree first, then archive by archive (in order of the
+                # first request of a key in it) in archive order, trailer
+                # last
+                assert names == [by_content[c] for c in
+                                 contents[:1] + contents[3:] +
+                                 contents[1:3]] + ['.ria-bundle-missing']
+                for m in members[:-1]:
+                    assert tar.extractfile(m).read() == keys[m.name][0]
+                assert tar.extractfile(members[-1]).read().decode() == \
+                    '{}\tnot present\n../escape\tinvalid\n'.format(missing)
+
+
+def test_git_wsgi():
+    import git_wsgi
+
+    def clone(url, path):
+        subprocess.run(['git', '-c', 'protocol.version={}'.format(version),
+                        'clone', '-q', url, str(path)],
+                       check=True, env=dict(os.environ, GIT_TERMINAL_PROMPT='0'))
+        return subprocess.run(['git', 'log', '--format=%s'], cwd=str(path),
+                              stdout=subprocess.PIPE, check=True,
+                              universal_newlines=True).stdout.split()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        store_dir, cache_dir, src = tmp / 'store', tmp / 'cache', tmp / 'src'
+        cache_dir.mkdir()
+        subprocess.run(['git', 'init', '-q', str(src)], check=True)
+        git = ['git', '-c', 'user.name=t', '-c', 'user.email=t@t']
+        subprocess.run(git + ['commit', '-q', '--allow-empty', '-m', 'one'],
+                       cwd=str(src), check=True)
+        repo = store_dir / 'abc' / 'def'
+        subprocess.run(['git', 'clone', '-q', '--bare', str(src), str(repo)],
+                       check=True)
+
+        cached = lambda: sorted(p.name for p in cache_dir.iterdir())
+        with patch.object(git_wsgi, 'CACHE_DIR', str(cache_dir)), \
+                patch.dict('os.environ', {'GIT_HTTP_EXPORT_ALL': '1'}), \
+                WSGITestServer(validator(git_wsgi.application),
+                               str(store_dir)) as url:
+            for version in (0, 2):
+                for p in cache_dir.iterdir():
+                    p.unlink()
+                history = clone(url + 'abc/def', tmp / 'c1_{}'.format(version))
+                assert history[-1] == 'one'
+                first = cached()
+                # the pack (and ls-refs of protocol v2)
+                assert len(first) == (1 if version == 0 else 2)
+                # served from the cache
+                assert clone(url + 'abc/def', tmp / 'c2_{}'.format(version)) \
+                    == history
+                assert cached() == first
+
+                # moved refs invalidate the cache
+                subprocess.run(git + ['commit', '-q', '--allow-empty', '-m',
+                                      'more{}'.format(version)],
+                               cwd=str(src), check=True)
+                subprocess.run(['git', 'push', '-q', str(repo), 'HEAD'],
+                               cwd=str(src), check=True)
+                assert clone(url + 'abc/def', tmp / 'c3_{}'.format(version)) \
+                    [0] == 'more{}'.format(version)
+                assert len(cached()) == 2 * len(first)
+
+                # fetches with "have" lines aren't cached
+                subprocess.run(['git', '-c', 'protocol.version=0', 'pull',
+                                '-q'],
+                               cwd=str(tmp / 'c1_{}'.format(version)),
+                               check=True)
+                assert len(cached()) == 2 * len(first)
+
+            # anything else is passed on to git-http-backend
+            r = requests.get(url + 'abc/def/HEAD')
+            assert r.status_code == 200
+            assert r.text.startswith('ref: ')
+            assert requests.get(url + 'abc/nothing/info/refs',
+                                params={'service': 'git-upload-pack'}) \
+                .status_code == 404